@@ -0,0 +1,44 @@
+"""
+Compares qrdar.common.distanceFilter with the original element-wise 
+implementation on clusters of 4 - 200 potential stickers
+
+usage: python benchmarks/bench_distance_filter.py
+"""
+
+import timeit
+import numpy as np
+import pandas as pd
+
+from scipy.spatial import distance_matrix
+
+from qrdar.common import distanceFilter, expected_distances, template
+
+def distanceFilter_loop(corners, template):
+
+    # original implementation, kept for comparison
+    tdM = expected_distances(template)
+    dist = distance_matrix(corners[['x', 'y', 'z']], corners[['x', 'y', 'z']])
+    dist_bool = np.array([False if v == 0 
+                          else True if np.any(np.isclose(v, tdM, atol=.02)) 
+                          else False for v in dist.flatten()]).reshape(dist.shape)
+    corners.loc[:, 'num_nbrs'] = [len(np.where(r == True)[0]) for r in dist_bool]
+    return corners[corners.num_nbrs <= 1].index
+
+def cluster(N, seed=0):
+
+    # a target plus N - 4 stickers scattered in a 1 m cube
+    rng = np.random.RandomState(seed)
+    xyz = np.vstack([template().values, rng.uniform(0, 1, (max(N - 4, 0), 3))])[:N]
+    return pd.DataFrame(xyz, columns=['x', 'y', 'z'])
+
+if __name__ == '__main__':
+
+    T = template()
+    print('{:>6} {:>12} {:>12} {:>8}'.format('N', 'loop (ms)', 'vector (ms)', 'speedup'))
+    for N in [4, 10, 25, 50, 100, 200]:
+        corners = cluster(N)
+        assert distanceFilter_loop(corners.copy(), T).equals(distanceFilter(corners.copy(), T))
+        n = max(1, int(200 / N))
+        t_loop = min(timeit.repeat(lambda: distanceFilter_loop(corners.copy(), T), number=n, repeat=3)) / n
+        t_vec = min(timeit.repeat(lambda: distanceFilter(corners.copy(), T), number=n, repeat=3)) / n
+        print('{:>6} {:>12.3f} {:>12.3f} {:>7.1f}x'.format(N, t_loop * 1e3, t_vec * 1e3, t_loop / t_vec))
@@ -0,0 +1,46 @@
+"""
+Times a cold `import qrdar` in fresh interpreters and checks that
+heavy optional dependencies are not imported until they are used
+
+usage: python benchmarks/bench_import.py [repeats]
+"""
+
+import os
+import sys
+import subprocess
+import numpy as np
+
+HEAVY = ['matplotlib', 'sklearn', 'scipy', 'skimage']
+
+CODE = """
+import sys, time
+t0 = time.perf_counter()
+import {module}
+t1 = time.perf_counter()
+print(t1 - t0)
+print(' '.join(m for m in {heavy} if m in sys.modules))
+"""
+
+def cold_import(module, python=sys.executable):
+
+    # a new interpreter per measurement so nothing is cached in sys.modules
+    env = dict(os.environ, PYTHONPATH=os.pathsep.join([os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+                                                       os.environ.get('PYTHONPATH', '')]))
+    out = subprocess.check_output([python, '-c', CODE.format(module=module, heavy=HEAVY)], env=env)
+    t, loaded = out.decode().split('\n')[:2]
+    return float(t), loaded.split()
+
+if __name__ == '__main__':
+
+    repeats = int(sys.argv[1]) if len(sys.argv) > 1 else 5
+
+    print('{:>20} {:>12} {:>12}  {}'.format('module', 'median (s)', 'min (s)', 'heavy modules loaded'))
+    for module in ['numpy', 'pandas', 'qrdar']:
+        times, loaded = [], []
+        for _ in range(repeats):
+            t, loaded = cold_import(module)
+            times.append(t)
+        print('{:>20} {:>12.3f} {:>12.3f}  {}'.format(module, np.median(times), np.min(times), ' '.join(loaded) or '-'))
+
+    # importing qrdar should not pull in plotting or clustering libraries
+    assert loaded == [], 'import qrdar loaded {}'.format(loaded)
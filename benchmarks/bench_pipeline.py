@@ -0,0 +1,106 @@
+"""
+End-to-end benchmark on synthetic plots, times each stage of the
+pipeline and reports throughput and peak (traced) memory
+
+usage: python benchmarks/bench_pipeline.py [--points 1e5 1e6] [--markers 10 50] [--odir DIR] [--profile]
+"""
+
+import os
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import numpy as np
+import pandas as pd
+
+import qrdar
+from qrdar.io import read_pcd, read_ply
+from qrdar.search4stickers import find, filterBySize
+from qrdar.readMarker import readCodes
+from qrdar.synthetic import synthetic_plot, write_tiles
+from qrdar.profiling import Profiler
+
+def measure(func, *args, **kwargs):
+
+    # wall time and peak memory allocated by python and numpy
+    tracemalloc.start()
+    t0 = time.perf_counter()
+    out = func(*args, **kwargs)
+    t = time.perf_counter() - t0
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    return out, t, peak
+
+def run(n_points, n_markers, odir, seed=0, profiler=None):
+
+    size = max(20., np.sqrt(n_markers) * 6)
+    pc, truth = synthetic_plot(n_markers, size=size, bg_density=n_points / size**2, seed=seed)
+    N = len(pc)
+
+    # tiles for the io and extractFeatures stages
+    tiles = os.path.join(odir, 'tiles')
+    tile_index = write_tiles(pc, tiles, fmt='pcd')
+    write_tiles(pc, tiles, fmt='ply')
+
+    rows = []
+    def stage(name, n, func, *args, **kwargs):
+        out, t, peak = measure(func, *args, **kwargs)
+        rows.append((N, n_markers, name, n, t, n / t if t > 0 else np.inf, peak / 1e6))
+        return out
+
+    stage('read_pcd', N, lambda: [read_pcd(os.path.join(tiles, 'tile_{}.pcd'.format(t))) for t in tile_index.tile])
+    stage('read_ply', N, lambda: [read_ply(os.path.join(tiles, 'tile_{}.ply'.format(t))) for t in tile_index.tile])
+    stage('read_pcd (bright)', N, lambda: [read_pcd(os.path.join(tiles, 'tile_{}.pcd'.format(t)),
+                                                     predicate=lambda c: c['intensity'] >= 5)
+                                            for t in tile_index.tile])
+
+    bright = pc[pc.intensity >= 5].copy()
+    bright = stage('find', len(bright), find, bright, profiler=profiler)
+    bright = stage('filterBySize', len(bright), filterBySize, bright, profiler=profiler)
+    bright, targets = stage('locateTargets', len(bright), qrdar.locateTargets, bright, 
+                            return_targets=True, profiler=profiler)
+    marker_df = stage('readCodes', n_markers, readCodes, bright, pc=pc, targets=targets, print_figure=False, 
+                      profiler=profiler, verbose=False)
+    stage('readCodes (tiles)', n_markers, readCodes, bright, tile_index=tile_index, print_figure=False,
+          refl_tiles_w_braces=os.path.join(tiles, 'tile_{}.pcd'), verbose=False)
+    out = os.path.join(odir, 'features')
+    if not os.path.isdir(out): os.makedirs(out)
+    stage('extractFeatures', n_markers, qrdar.extractFeatures, marker_df, tile_index,
+          os.path.join(tiles, 'tile_{}.pcd'), out, profiler=profiler, verbose=False)
+    stage('extractFeatures (voxel)', n_markers, qrdar.extractFeatures, marker_df, tile_index,
+          os.path.join(tiles, 'tile_{}.pcd'), out, voxel_size=.02, verbose=False)
+
+    correct = np.isin(truth.code, marker_df.code.dropna().astype(int)).sum()
+    return rows, correct
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--points', type=float, nargs='+', default=[1e5, 1e6], help='background points per plot')
+    parser.add_argument('--markers', type=int, nargs='+', default=[10, 50], help='markers per plot')
+    parser.add_argument('--odir', type=str, default=None, help='directory for tiles, a temporary one if not set')
+    parser.add_argument('--csv', type=str, default=None, help='save results to csv')
+    parser.add_argument('--profile', action='store_true', help='print a summary of the spans within each stage')
+    args = parser.parse_args()
+
+    odir = args.odir if args.odir is not None else tempfile.mkdtemp()
+    results = []
+    try:
+        for n_points in args.points:
+            for n_markers in args.markers:
+                profiler = Profiler() if args.profile else None
+                rows, correct = run(int(n_points), n_markers, os.path.join(odir, '{}_{}'.format(int(n_points), n_markers)),
+                                    profiler=profiler)
+                results += rows
+                print('{:.0e} points, {} markers: {} codes read correctly'.format(n_points, n_markers, correct))
+                if profiler is not None:
+                    with pd.option_context('display.width', 200, 'display.max_rows', 500):
+                        print(profiler.summary())
+    finally:
+        if args.odir is None: shutil.rmtree(odir)
+
+    results = pd.DataFrame(results, columns=['points', 'markers', 'stage', 'n', 'time (s)', 'n / s', 'peak (MB)'])
+    with pd.option_context('display.width', 200, 'display.max_rows', 500, 'display.float_format', '{:.3f}'.format):
+        print(results)
+    if args.csv is not None: results.to_csv(args.csv, index=False)
@@ -1,7 +1,33 @@
+import importlib
+
 from qrdar.io import *
-from .search4stickers import read
-from . import search4stickers
 from .locateTargets import *
-from . import readMarker
 from .extractFeatures import extractFeatures
-from .scripts.identify_codes import identify_codes_in_pc as identify_codes
+
+# remaining submodules are imported on first use, see __getattr__
+_lazy = {'read':('.search4stickers', 'read'),
+         'search4stickers':('.search4stickers', None),
+         'readMarker':('.readMarker', None),
+         'common':('.common', None),
+         'diagnostics':('.diagnostics', None),
+         'pipeline':('.pipeline', None),
+         'synthetic':('.synthetic', None),
+         'profiling':('.profiling', None),
+         'Profiler':('.profiling', 'Profiler'),
+         'process_tiles':('.pipeline', 'process_tiles'),
+         'identify_codes':('.scripts.identify_codes', 'identify_codes_in_pc')}
+
+def __getattr__(name):
+
+    if name not in _lazy:
+        raise AttributeError('module {} has no attribute {}'.format(__name__, name))
+
+    module, attr = _lazy[name]
+    value = importlib.import_module(module, __name__)
+    if attr is not None: value = getattr(value, attr)
+    globals()[name] = value
+    return value
+
+def __dir__():
+
+    return sorted(list(globals()) + list(_lazy))
@@ -2,17 +2,13 @@ import os
 import pandas as pd
 import numpy as np
 import itertools
-
-from sklearn.cluster import DBSCAN
-from scipy.spatial import distance_matrix as distance_matrix
-from scipy.optimize import curve_fit
+import functools
 
 import qrdar
 from qrdar.io.pcd_io import *
 
-import matplotlib.pyplot as plt
-
-from skimage.filters import threshold_otsu
+# sklearn, scipy and skimage are imported where they are used
+# so that importing qrdar stays fast
 
 
 # a bit of hack for Python 2.x
@@ -20,6 +16,8 @@ __dir__ = os.path.split(os.path.abspath(qrdar.__file__))[0]
 
 def nn(arr):
 
+    from sklearn.neighbors import NearestNeighbors
+
     nbrs = NearestNeighbors(n_neighbors=3, algorithm='kd_tree').fit(arr)
     distances, indices = nbrs.kneighbors(arr)
     
@@ -27,95 +25,212 @@ def nn(arr):
 
 def distanceFilter(corners, template):
     
-    tdM = expected_distances(template)
+    from scipy.spatial import distance_matrix
+
+    tdM = np.ma.compressed(expected_distances(template))
     
     # remove points that are not ~ correct distance from at least
     # 2 others according to template
-    dist = distance_matrix(corners[['x', 'y', 'z']], corners[['x', 'y', 'z']])
-    dist_bool = np.array([False if v == 0 
-                          else True if np.any(np.isclose(v, tdM, atol=.02)) 
-                          else False for v in dist.flatten()]).reshape(dist.shape)
-    corners.loc[:, 'num_nbrs'] = [len(np.where(r == True)[0]) for r in dist_bool]
+    xyz = corners[['x', 'y', 'z']].values
+    dist = distance_matrix(xyz, xyz)
+    dist_bool = np.isclose(dist[:, :, np.newaxis], tdM, atol=.02).any(axis=2) & (dist != 0)
+    corners.loc[:, 'num_nbrs'] = dist_bool.sum(axis=1)
     remove_idx = corners[corners.num_nbrs <= 1].index
     
     return remove_idx
 
-def calculate_R(corners, template):
-    
-    tdM = expected_distances(template)
+def calculate_R(corners, template, chunk_size=4096, counters=None):
+
+    """
+    Finds the first combination of 4 (or 3) stickers that fits the 
+    template with an rmse < .01, combinations and template permutations
+    are tried in the same order as itertools.
+
+    Candidates are pruned on the distance between stickers before any
+    fitting; a fit with rmse < .01 can not change the distance between
+    any two stickers by more than 2 * .01 * sqrt(N). Remaining fits are
+    solved as a batch.
+
+    If a dict is passed as counters the number of combinations tried 
+    and fits solved are added to 'combinations' and 'fits'.
+
+    Returns
+    -------
+    idx: list
+        index of corners that fit the template
+    R: np.array
+        4 x 4 transformation from corners to template
+    rmse: float
+    """
+
+    tdM = np.ma.compressed(expected_distances(template))
+    xyz = corners[['x', 'y', 'z']].values.astype(float)
+    T = template[['x', 'y', 'z']].values.astype(float)
     
     for N in [4, 3]:
+
+        combos = np.array([c for c in itertools.combinations(range(len(xyz)), N)], dtype=int)
+        perms = np.array([p for p in itertools.permutations(range(len(T)), N)], dtype=int)
+        if len(combos) == 0: continue
+        iu = np.triu_indices(N, 1)
+        t_dist = _pairwise_distances(T[perms])[:, iu[0], iu[1]]
         
-        combinations = [c for c in itertools.combinations(corners.index, N)]
+        for c in range(0, len(combos), chunk_size):
 
-        for combo in combinations:
-            
-            test = corners.loc[list(combo)].copy()
-            test = test.sort_values(['x', 'y', 'z']).reset_index()
+            # sort points in each combination by x, y then z
+            test = xyz[combos[c:c + chunk_size]]
+            if counters is not None: counters['combinations'] = counters.get('combinations', 0) + len(test)
+            order = np.lexsort((test[:, :, 2], test[:, :, 1], test[:, :, 0]), axis=-1)
+            test = np.take_along_axis(test, order[:, :, np.newaxis], axis=1)
             
             # skip set of points where the seperation is too large
-            dM = distance_matrix(test[['x', 'y', 'z']], test[['x', 'y', 'z']])
-            dM = np.ma.masked_equal(dM, 0)
-            if np.any(dM > tdM.max() * 1.05) or np.any(dM < tdM.min() * .95): continue
+            dM = _pairwise_distances(test)
+            bad = ((dM > tdM.max() * 1.05) | (dM < tdM.min() * .95)) & (dM != 0)
+            keep = np.where(~np.any(bad, axis=(1, 2)))[0]
+            if len(keep) == 0: continue
+
+            # skip template permutations where distances can not match
+            diff = np.abs(dM[keep][:, iu[0], iu[1]][:, np.newaxis, :] - t_dist[np.newaxis])
+            ci, pi = np.where(np.all(diff <= 2 * .01 * np.sqrt(N), axis=2))
+            if len(ci) == 0: continue
+
+            M, rmse = rigid_transform_3D_batch(test[keep[ci]], T[perms[pi]])
+            if counters is not None: counters['fits'] = counters.get('fits', 0) + len(ci)
+            hit = np.where(rmse < .01)[0]
+            if len(hit) > 0:
+                h = hit[0]
+                return list(corners.index[combos[c + keep[ci[h]]]]), M[h], rmse[h]
 
-            for t_combo in itertools.permutations(template.index, N):
-                
-                t_pd = template.loc[list(t_combo)]
+    return [], [], np.nan
 
-                R = rigid_transform_3D(test[['x', 'y', 'z']].values, t_pd) 
-                testR = apply_rotation(R, test.copy())
+def _pairwise_distances(pts):
 
-                rmse = np.sqrt((np.linalg.norm(testR[['x', 'y', 'z']].values - t_pd.values, axis=1)**2).mean())
-                
-                if rmse < .01:
-                    return list(combo), R, rmse
+    """ distance matrix of each set in a stack of point sets (B x N x 3) """
 
-    return [], [], np.nan
+    return np.sqrt(((pts[:, :, np.newaxis, :] - pts[:, np.newaxis, :, :])**2).sum(axis=3))
 
 def apply_rotation(M, df):
+
+    """
+    applies transform M (4 x 4) to the x, y and z fields of df, 
+    returns a new DataFrame and leaves df unchanged
+    """
     
-    if 'a' not in df.columns:
-        df.loc[:, 'a'] = 1
+    xyz = transform_points(M, df[['x', 'y', 'z']].values, dtype=np.float64)
     
-    r_ = np.dot(M, df[['x', 'y', 'z', 'a']].T).T
-    df.loc[:, ['x', 'y', 'z']] = r_[:, :3]
+    return pd.DataFrame(xyz, index=df.index, columns=['x', 'y', 'z'])
+
+def transform_points(M, xyz, out=None, dtype=None, chunk_size=1000000):
+
+    """
+    Applies transform M (4 x 4) to points as R.p + t without building
+    homogeneous coordinates. 
+
+    Parameters
+    ----------
+    M: np.array (4 x 4)
+        rigid transform
+    xyz: np.array (N x 3)
+        points
+    out: None or np.array (N x 3) (default None)
+        array to write to, pass xyz to transform in place
+    dtype: None or np.dtype (default None)
+        dtype of out if it is created, defaults to the dtype of xyz so 
+        float32 points stay float32 
+    chunk_size: int (default 1e6)
+        points are transformed in chunks (in float64) so temporary 
+        memory is bounded by chunk_size
+
+    Returns
+    -------
+    out: np.array (N x 3)
+    """
+
+    xyz = np.asarray(xyz)
+    if out is None:
+        if dtype is None:
+            dtype = xyz.dtype if np.issubdtype(xyz.dtype, np.floating) else np.float64
+        out = np.empty(xyz.shape, dtype=dtype)
+
+    R, t = np.asarray(M, dtype=np.float64)[:3, :3], np.asarray(M, dtype=np.float64)[:3, 3]
+    for i in range(0, len(xyz), int(chunk_size)):
+        chunk = slice(i, i + int(chunk_size))
+        out[chunk] = np.dot(xyz[chunk], R.T) + t
+
+    return out
+
+def invert_transform(M):
+
+    """
+    inverse of a rigid transform (4 x 4)
+    """
+
+    Mi = np.identity(4)
+    Mi[:3, :3] = M[:3, :3].T
+    Mi[:3, 3] = -np.dot(M[:3, :3].T, M[:3, 3])
     
-    return df[['x', 'y', 'z']]
+    return Mi
 
 def rigid_transform_3D(A, B):
     
     """
-    http://nghiaho.com/uploads/code/rigid_transform_3D.py_
+    rigid transform (4 x 4) that maps points A (N x 3) onto B (N x 3)
     """
     
     assert len(A) == len(B)
-    
-    A = np.matrixlib.defmatrix.matrix(A)
-    B = np.matrixlib.defmatrix.matrix(B)
 
-    N = A.shape[0]; # total points
+    M, rmse = rigid_transform_3D_batch(np.asarray(A, dtype=float)[np.newaxis], 
+                                       np.asarray(B, dtype=float)[np.newaxis])
 
-    centroid_A = np.mean(A, axis=0).reshape(1, 3)
-    centroid_B = np.mean(B, axis=0).reshape(1, 3)
-    
-    # centre the points
-    AA = A - np.tile(centroid_A, (N, 1))
-    BB = B - np.tile(centroid_B, (N, 1))
+    return M[0]
 
-    # dot is matrix multiplication for array
-    H = np.transpose(AA) * BB
+def rigid_transform_3D_batch(A, B):
 
-    U, S, Vt = np.linalg.svd(H)
+    """
+    Least squares rigid transforms (Kabsch) for a stack of point sets,
+    reflections are corrected so every transform is a proper rotation.
+    http://nghiaho.com/?page_id=671
+
+    Parameters
+    ----------
+    A: np.array (B x N x 3)
+        source points
+    B: np.array (B x N x 3)
+        target points
+
+    Returns
+    -------
+    M: np.array (B x 4 x 4)
+        transforms mapping each set of A onto B
+    rmse: np.array (B)
+        rmse of each fit
+    """
 
-    R = np.dot(Vt.T, U.T)
-    
-    t = -R*centroid_A.T + centroid_B.T
-    
-    M, N = np.identity(4), np.identity(4)
-    M[:3, :3] = R
-    N[:3, 3] = t.reshape(-1, 3)
+    A, B = np.asarray(A, dtype=float), np.asarray(B, dtype=float)
+    assert A.shape == B.shape
+
+    # centre the points
+    cA, cB = A.mean(axis=1, keepdims=True), B.mean(axis=1, keepdims=True)
+    H = np.matmul((A - cA).transpose(0, 2, 1), B - cB)
+
+    U, S, Vt = np.linalg.svd(H)
+    V, Ut = Vt.transpose(0, 2, 1), U.transpose(0, 2, 1)
     
-    return np.dot(N, M)
+    # reflection correction
+    D = np.tile(np.identity(3), (len(A), 1, 1))
+    D[:, 2, 2] = np.sign(np.linalg.det(np.matmul(V, Ut)))
+    D[D[:, 2, 2] == 0, 2, 2] = 1
+    R = np.matmul(np.matmul(V, D), Ut)
+    t = cB[:, 0] - np.einsum('bij,bj->bi', R, cA[:, 0])
+
+    M = np.tile(np.identity(4), (len(A), 1, 1))
+    M[:, :3, :3] = R
+    M[:, :3, 3] = t
+
+    residual = np.einsum('bij,bnj->bni', R, A) + t[:, np.newaxis] - B
+    rmse = np.sqrt((residual**2).sum(axis=2).mean(axis=1))
+
+    return M, rmse
 
 def gauss(x, mu, sigma, A):
     
@@ -127,6 +242,8 @@ def bimodal(x,mu1,sigma1,A1,mu2,sigma2,A2):
 
 def calculate_cutoff(data, p):
 
+    from scipy.optimize import curve_fit
+
     bins = np.linspace(np.floor(data.min()), np.ceil(data.max()))
     y, x = np.histogram(data, bins=bins)
     x = (x[1:] + x[:-1]) / 2 # for len(x)==len(y)
@@ -139,18 +256,89 @@ def calculate_cutoff(data, p):
 
 def expected_distances(template):
     
+    from scipy.spatial import distance_matrix
+
     # distances between points
     tdM = distance_matrix(template[['x', 'y', 'z']], template[['x', 'y', 'z']])
     tdM = np.ma.masked_equal(tdM, 0)
     return np.unique(tdM)
 
+code_dicts = {'aruco_mip_16h3':'aruco_mip_16h3_dict.npy',
+              'aruco_mip_36h12':'aruco_mip_36h12_dict.npy'}
+
+def register_codes(name, codes):
+
+    """
+    registers a dictionary of codes so it can be loaded by name with
+    load_codes and passed as codes_dict to readCodes
+
+    Parameters
+    ----------
+    name: str
+        name of the dictionary, an existing name is replaced
+    codes: str or np.array
+        path to a .npy file (relative to the working directory) or an 
+        m x m x n array of binary codes 
+        e.g. as generated in markers/create_markers.ipynb
+    """
+
+    if isinstance(codes, str):
+        # relative to the caller, only built in dictionaries are 
+        # relative to the package
+        codes = os.path.abspath(codes)
+    else:
+        codes = np.array(codes)
+        if codes.ndim != 3 or codes.shape[0] != codes.shape[1]:
+            raise ValueError('codes must be an m x m x n array, got shape {}'.format(codes.shape))
+    code_dicts[name] = codes
+    _load_codes.cache_clear()
+    load_code_index.cache_clear()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_codes(dic):
+
+    if dic not in code_dicts:
+        raise KeyError('unknown code dictionary {}, available dictionaries are {} ' \
+                       '(use register_codes to add one)'.format(dic, list(code_dicts)))
+
+    codes = code_dicts[dic]
+    if isinstance(codes, str):
+        codes = np.load(codes if os.path.isabs(codes) else os.path.join(__dir__, codes))
+    codes = np.array(codes)
+    codes.flags.writeable = False # shared between calls
+    return codes
+
 def load_codes(dic):
 
-    if dic == 'aruco_mip_16h3':
-        return np.load(os.path.join(__dir__, 'aruco_mip_16h3_dict.npy'))
-    elif dic == 'aruco_mip_36h12':
-        return np.load(os.path.join(__dir__, 'aruco_mip_36h12_dict.npy'))
-    
+    """
+    returns the m x m x n array of codes for a named dictionary, each
+    dictionary is read from disk once and then cached
+    """
+
+    return _load_codes(dic)
+
+
+@functools.lru_cache(maxsize=None)
+def load_code_index(dic):
+
+    """
+    returns the code_index of a named dictionary, cached so it is
+    only computed once
+    """
+
+    return code_index(load_codes(dic))
+
+
+def subset_index(index, expected_codes):
+
+    """
+    selects expected_codes from a code_index without recomputing it
+    """
+
+    bits = index['bits'][:, np.asarray(expected_codes, dtype=int)]
+    return {'bits':bits, 'N':index['N'], 'n_codes':bits.shape[1]}
+
 def template():
 
     markerTemplate = np.array([[ 0.      ,  0, 0.      ],
@@ -160,26 +348,152 @@ def template():
 
     return pd.DataFrame(data=markerTemplate, columns=['x', 'y', 'z'])
 
-def calculate_score(img, codes, N=6):
+def code_index(codes):
+
+    """
+    precomputes a packed bit representation of every code in all
+    four rotations so that an image can be scored against the whole
+    dictionary with a single Hamming distance operation
+
+    Parameters
+    ----------
+    codes: np.array
+        N x N x K array of binary codes e.g. from load_codes
+
+    Returns
+    -------
+    index: dict
+        bits: 4 x K x B uint8 array of packed codes where rotation r 
+        is the code rotated r quarter turns clockwise, N: size of the 
+        code and n_codes: K
+    """
+
+    codes = np.asarray(codes)
+    N, K = codes.shape[0], codes.shape[2]
+    rotated = np.stack([np.rot90(codes, -r, axes=(0, 1)) for r in range(4)]) # 4 x N x N x K
+    rotated = rotated.transpose(0, 3, 1, 2).reshape(4, K, N * N) > .5
+
+    return {'bits':np.packbits(rotated, axis=2), 'N':N, 'n_codes':K}
+
+
+_popcount_table = np.array([bin(b).count('1') for b in range(256)], dtype=np.uint8)
+
+def score_code(img, index):
+
+    """
+    scores a binary image against every code and rotation in a
+    code index
+
+    Parameters
+    ----------
+    img: np.array
+        N x N binary image of the marker
+    index: dict
+        output of code_index
+
+    Returns
+    -------
+    code: int
+        index of the best matching code
+    rotation: int
+        number of clockwise quarter turns from the code to the image
+    confidence: float
+        proportion of the inner (non-border) cells that match
+    margin: int
+        difference in the number of matching cells between the best
+        code and the best of the remaining codes
+    """
+
+    N = index['N']
+    bits = np.packbits(np.rot90(np.asarray(img)).reshape(-1) > .5)
+    distance = _popcount_table[index['bits'] ^ bits].sum(axis=2, dtype=np.int64) # 4 x K
+    score = N**2 - distance
+
+    # ties go to the lowest rotation then lowest code
+    rotation, code = np.unravel_index(np.argmax(score), score.shape)
+    best = score.max(axis=0)
+    runner_up = np.delete(best, code).max() if len(best) > 1 else 0
+ 
+    size_of_inner = float((N - 2)**2)
+    confidence = (score[rotation, code] - (N**2 - size_of_inner)) / size_of_inner
+
+    return int(code), int(rotation), confidence, int(score[rotation, code] - runner_up)
+
+
+def calculate_score(img, codes, N=None):
     
-    size_of_code = float(N**2)
-    size_of_inner = float((N-2)**2)
-    size_diff = size_of_code - size_of_inner
+    """
+    returns the best matching code and confidence for img, codes is
+    either an N x N x K array of codes or the output of code_index,
+    N is taken from the codes and is kept for compatibility
+    """
 
-    score = np.array([(np.rot90(img) == codes[:, :, j]).astype(int).sum() for j in range(codes.shape[2])])
-    code = int(np.where(score == score.max())[0][0])
-    confidence = ((size_of_inner - (size_of_inner - (score.max() - size_diff))) / size_of_inner)
+    if not isinstance(codes, dict): codes = code_index(codes)
+    code, rotation, confidence, margin = score_code(img, codes)
 
     return code, confidence
 
-def method_1(code):
+def rasterise_code(code, N=None, low_intensity=-7):
+
+    """
+    rasterises the points of a fiducial marker onto the code grid
+    in a single pass, all binarisation methods are derived from
+    the returned grids
+
+    Parameters
+    ----------
+    code: pd.DataFrame
+        marker points with grid cell indices xx and zz and intensity
+    N: int or None (default None)
+        number of cells along each side of the grid, if None this is
+        len(code.xx.unique()) - 1
+    low_intensity: float (default -7)
+        returns with an intensity below this are counted as low
+        returns (RIEGL specific)
+
+    Returns
+    -------
+    grids: dict
+        N x N arrays of the point count (count), mean intensity
+        (I_mean) and fraction of low returns (P) per cell, cells
+        without points are NaN in I_mean and P, the Otsu threshold of 
+        the point intensities is also returned (thresh)
+    """
+
+    from skimage.filters import threshold_otsu
+
+    xx = np.asarray(code.xx, dtype=float)
+    zz = np.asarray(code.zz, dtype=float)
+    intensity = np.asarray(code.intensity, dtype=float)
+    if N is None: N = len(np.unique(xx)) - 1
+    N = int(N)
+
+    inside = (xx >= 0) & (xx < N) & (zz >= 0) & (zz < N)
+    cell = (xx[inside] * N + zz[inside]).astype(np.intp)
+    I = intensity[inside]
+
+    count = np.bincount(cell, minlength=N**2)
+    total = np.bincount(cell, weights=I, minlength=N**2)
+    low = np.bincount(cell, weights=(I < low_intensity), minlength=N**2)
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        I_mean = total / count
+        P = low / count
+
+    return {'count':count.reshape(N, N),
+            'I_mean':I_mean.reshape(N, N),
+            'P':P.reshape(N, N),
+            'thresh':threshold_otsu(intensity) if len(intensity) > 0 else np.nan}
+
+
+def method_1(code, grids=None):
 
     """
     method 1 calculates the reflectance threshold between white and black
     areas of the target and uses this to create a binary filter
     """
     
-    code.loc[:, 'I_mean'] = code.groupby(['xx', 'zz']).intensity.transform(np.mean)
+    if grids is None: grids = rasterise_code(code)
 
 #     for p in np.arange(5, 50, 5):
 #         try:
@@ -192,15 +506,12 @@ def method_1(code):
 
 #     print ('C:', C)
     
-    thresh = threshold_otsu(code.intensity)
-
-    code.loc[:, 'bw1'] = np.where(code.I_mean < thresh, 0, 1)
-    img_1 = ensure_square_arr(code, 'bw1', len(code.xx.unique()) - 1)
+    img_1 = (grids['count'] > 0) & (grids['I_mean'] >= grids['thresh'])
 
-    return img_1
+    return black_border(img_1.astype(float))
 
 
-def method_2(code, threshold):
+def method_2(code, threshold, grids=None):
     
     """
     method 2 calculate the number of returns on a per grid square
@@ -211,25 +522,29 @@ def method_2(code, threshold):
     RIEGL specific: todo expose intensity threshold
     """
 
-    code.loc[:, 'N'] = code.groupby(['xx', 'zz']).x.transform(np.size)
-    LN = code[(code.intensity < -7)].groupby(['xx', 'zz']).x.size().reset_index(name='LN')
-    code = pd.merge(LN, code, on=['xx', 'zz'], how='outer')
-    code.loc[:, 'P'] = code.LN / code.N
+    if grids is None: grids = rasterise_code(code)
+
+    img = (grids['count'] > 0) & ~(grids['P'] > threshold)
 
-    code.loc[:, 'bw2'] = code.P.apply(lambda p: 0 if p > threshold else 1)
-    img = ensure_square_arr(code, 'bw2', len(code.xx.unique()) - 1)
+    return black_border(img.astype(float))
 
-    return img
+
+def black_border(img):
+
+    """
+    forces the border of the code to be black
+    """
+
+    return img * np.pad(np.ones(np.array(img.shape) - 2), 1, 'constant')
 
 
 def ensure_square_arr(df, var, N):
     
-    X, Y = np.meshgrid(np.arange(0, N), np.arange(0, N))
-    x_df = pd.DataFrame(np.vstack([Y.flatten(), X.flatten()]).T, columns=['xx', 'zz'])
-        
-    b_df = df.groupby(['xx', 'zz'])[var].mean().reset_index()
-    img = pd.merge(x_df, b_df, on=['xx', 'zz'], how='left')
-    img.loc[np.isnan(img[var]), var] = 0
-    img = img[var].values.reshape(N, N)
-    img = img * np.pad(np.ones(np.array(img.shape) - 2), 1, 'constant') # force border to be black
-    return img
+    xx, zz = np.asarray(df.xx, dtype=float), np.asarray(df.zz, dtype=float)
+    inside = (xx >= 0) & (xx < N) & (zz >= 0) & (zz < N)
+    cell = (xx[inside] * N + zz[inside]).astype(np.intp)
+
+    count = np.bincount(cell, minlength=N**2)
+    total = np.bincount(cell, weights=np.asarray(df[var], dtype=float)[inside], minlength=N**2)
+    img = np.divide(total, count, out=np.zeros(N**2), where=count > 0).reshape(N, N)
+    return black_border(img)
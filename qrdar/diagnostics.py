@@ -0,0 +1,161 @@
+import os
+import warnings
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+# matplotlib is only imported by render_record so that decoding and
+# writing diagnostics do not require it
+
+def decimate(arr, max_points=5000):
+
+    """
+    evenly spaced subsample of the rows of arr, order is preserved
+    """
+
+    arr = np.asarray(arr)
+    if len(arr) <= max_points: return arr
+    return arr[np.linspace(0, len(arr) - 1, max_points).astype(int)]
+
+
+def write_diagnostics(path, records):
+
+    """
+    writes diagnostic records from readCodes to a single compressed
+    archive, arrays are stored as <record>/<name>
+
+    Parameters
+    ----------
+    path: str
+        path of the .npz archive
+    records: list of dict
+        per target records of arrays and scalars
+    """
+
+    arrays = {}
+    for r, record in enumerate(records):
+        for k, v in record.items():
+            arrays['{}/{}'.format(r, k)] = np.asarray(v if not isinstance(v, list) else str(v))
+    np.savez_compressed(path, **arrays)
+
+
+def read_diagnostics(path):
+
+    """
+    reads records written by write_diagnostics, returns a list of dict
+    """
+
+    records = {}
+    with np.load(path) as npz:
+        for key in npz.files:
+            r, k = key.split('/', 1)
+            v = npz[key]
+            records.setdefault(int(r), {})[k] = v.item() if v.ndim == 0 else v
+
+    return [records[r] for r in sorted(records)]
+
+
+def render_record(record, out_dir='.'):
+
+    """
+    renders a diagnostic record to <out_dir>/<i>.png with the Agg
+    backend and returns the file name
+    """
+
+    from matplotlib.figure import Figure
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    import matplotlib.cm as cm
+
+    f = Figure(figsize=(10, 5))
+    FigureCanvasAgg(f)
+    f.text(.01, .05, 'cluster: {}'.format(record['i']), ha='left')
+    ax1 = f.add_axes([0, 0, .32, 1])
+    ax2 = f.add_axes([.33, .5, .32, .49])
+    ax3 = f.add_axes([.33, 0, .32, .49])
+    ax4 = f.add_axes([.66, 0, .32, .49])
+    ax5 = f.add_axes([.66, .5, .32, .49])
+    [ax.axis('off') for ax in [ax1, ax2, ax3, ax4, ax5]]
+
+    # rotated point cloud with template and sticker locations
+    if 'points' in record:
+        points = record['points']
+        ax1.scatter(points[:, 0], points[:, 1], c=points[:, 2], edgecolor='none', s=1, cmap=cm.Spectral_r)
+        ax1.scatter(record['template'][:, 0], record['template'][:, 1], s=30, edgecolor='b', facecolor='none')
+        ax1.scatter(record['stickers'][:, 0], record['stickers'][:, 1], s=30, edgecolor='r', facecolor='none')
+
+    # extracted code with grid
+    if 'code_points' in record:
+        points = record['code_points']
+        ax2.scatter(points[:, 0], points[:, 1], c=points[:, 2], edgecolor='none',
+                    s=10, cmap=cm.Greys_r, vmin=-10, vmax=0)
+        [ax2.axhline(z, c='r') for z in record['hlines']]
+        [ax2.axvline(x, c='r') for x in record['vlines']]
+
+    # binary images from each method
+    for ax, img in zip([ax3, ax4, ax5], ['img_1', 'img_2', 'img_3']):
+        if img in record:
+            ax.imshow(np.rot90(record[img], 1), cmap=cm.Greys_r, interpolation='none')
+
+    if 'code' in record:
+        f.text(.01, .01, 'code: {} ({})'.format(record['code'], record['confidence']))
+
+    fn = os.path.join(out_dir, '{}.png'.format(record['i']))
+    f.savefig(fn)
+    f.clear() # release artists, the figure is not registered with pyplot
+
+    return fn
+
+
+def render_diagnostics(records, out_dir='.', n_jobs=1, executor=None, background=False):
+
+    """
+    renders diagnostic records to png, one image per target
+
+    Parameters
+    ----------
+    records: str or list of dict
+        path to an archive written by write_diagnostics or a list
+        of records
+    out_dir: str (default '.')
+        directory to save images to
+    n_jobs: int (default 1)
+        number of worker processes used to render, -1 uses all cores
+    executor: None or concurrent.futures.Executor (default None)
+        executor to render with, rendering is submitted in the
+        background and a list of futures is returned
+    background: boolean (default False)
+        if no executor is given, render in a pool of n_jobs worker 
+        processes without waiting and return a list of futures
+
+    Returns
+    -------
+    images: list
+        file names of the rendered images, or futures if executor
+        is specified or background is True. Render errors are raised 
+        by future.result() and also reported with a warning
+    """
+
+    if isinstance(records, str):
+        records = read_diagnostics(records)
+    if not os.path.isdir(out_dir): os.makedirs(out_dir)
+
+    if executor is not None or (background and len(records) > 0):
+        pool = executor
+        if pool is None:
+            pool = ProcessPoolExecutor(max_workers=os.cpu_count() if n_jobs < 1 else n_jobs)
+        futures = [pool.submit(render_record, record, out_dir) for record in records]
+        for future in futures: future.add_done_callback(_warn_on_error)
+        # submitted work carries on after the pool is shut down
+        if executor is None: pool.shutdown(wait=False)
+        return futures
+    elif n_jobs != 1 and len(records) > 1:
+        n_jobs = os.cpu_count() if n_jobs < 1 else n_jobs
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            return list(pool.map(render_record, records, [out_dir] * len(records)))
+    else:
+        return [render_record(record, out_dir) for record in records]
+
+
+def _warn_on_error(future):
+
+    if not future.cancelled() and future.exception() is not None:
+        warnings.warn('rendering diagnostics failed: {!r}'.format(future.exception()))
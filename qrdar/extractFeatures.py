@@ -4,8 +4,14 @@ import numpy as np
 from qrdar.common import *
 from qrdar.io.pcd_io import *
 from qrdar.io.ply_io import *
+from qrdar.io.cache import *
+from qrdar.io.spatial_index import *
+from qrdar.io.batch import *
+from qrdar.profiling import as_profiler
 
-def extractFeatures(marker_df, tile_index, extract_tiles_w_braces, out_dir, verbose=True):
+def extractFeatures(marker_df, tile_index, extract_tiles_w_braces, out_dir, verbose=True,
+                    cache=None, batch_size=50, pc=None, pc_index=None, voxel_size=None, 
+                    tile_size=None, profiler=None):
     
     """
     extract features from main dataset that are coincident with the marker.
@@ -15,19 +21,50 @@ def extractFeatures(marker_df, tile_index, extract_tiles_w_braces, out_dir, verb
     ----------
     marker_df: pd.DataFrame
         output from qrdar.readMarker
-    tile_index: pd.DataFrame [required fields are ['x', 'y', 'tile_number']]
-        tile index as dataframe
+    tile_index: pd.DataFrame [required fields are ['x', 'y', 'tile']] or qrdar.io.TileIndex
+        tile index as dataframe of tile centres or a prebuilt TileIndex, 
+        can be None if pc is given
     extract_tiles_w_braces: str with {}
-        path to tiles where tile number is replaced with {} e.g. '../tiles/tile_{}.pcd'  
+        path to tiles where tile number is replaced with {} e.g. '../tiles/tile_{}.pcd',
+        can be None if pc is given
     out_dir: str
         filepath to output directory
     verbose: boolean
         print something
+    cache: None or qrdar.io.TileCache (default None)
+        tiles are read from the cache, useful when rerunning with different
+        parameters
+    batch_size: int (default 50)
+        number of neighbouring markers whose points are read together, 
+        each tile is read once per batch
+    pc: None or pd.DataFrame (default None)
+        point cloud held in memory to extract features from instead of
+        reading tiles
+    pc_index: None or qrdar.io.PointIndex (default None)
+        spatial index of pc, built if pc is given and pc_index is None
+    voxel_size: None or float (default None)
+        if set, points are averaged into voxels of this edge length which
+        are clustered (weighted by their number of points) and labels 
+        are given back to the points. Much faster for dense data, should
+        be well below the clustering distance (.1) e.g. .02
+    tile_size: None or float (default None)
+        edge length of tiles when tile_index is tile centres, if None it is
+        the spacing between tile centres
+    profiler: None or qrdar.profiling.Profiler (default None)
+        records an 'extractFeatures' span with 'read tiles' spans per 
+        batch and 'crop', 'cluster' and 'write' spans per feature
     """
-    
+
+    assert (pc is None) != (tile_index is None), 'either pc or tile_index needs to be specified'
+    profiler = as_profiler(profiler)
+    if pc is not None:
+        if pc_index is None: pc_index = PointIndex(pc)
+    else:
+        tile_index = as_tile_index(tile_index, tile_size=tile_size)
+
+    features = []
     for ix, row in marker_df.iterrows():
         
-        if verbose: print('extracting feature:', row.code)
         corners = pd.DataFrame(columns=['x', 'y', 'z'])
         for i, c in enumerate([row.c0, row.c1, row.c2, row.c3]):
             if isinstance(c, str): 
@@ -36,51 +73,117 @@ def extractFeatures(marker_df, tile_index, extract_tiles_w_braces, out_dir, verb
             if i == 3 and isinstance(c, float): continue
             corners.loc[i, ['x', 'y', 'z']] = list(c)
         if len(corners) == 0: continue
-        v = _extract_feature(row.code, corners, tile_index, extract_tiles_w_braces, out_dir, verbose)
+        features.append((row.code, corners.astype(float)))
+
+    # group neighbouring markers so tiles are shared within a batch
+    if len(features) == 0: return
+    centres = np.array([corners[['x', 'y']].mean().values for code, corners in features])
+    order = np.lexsort((centres[:, 1] // 10, centres[:, 0] // 10))
+
+    with profiler.span('extractFeatures', targets=len(features)):
+        for b in range(0, len(features), batch_size):
+            batch = [features[i] for i in order[b:b + batch_size]]
+            bboxes = {i: feature_bbox(corners) for i, (code, corners) in enumerate(batch)}
+            with profiler.span('read tiles', targets=len(batch)) as span:
+                if pc is not None:
+                    points = {i: pc_index.crop(pc, bbox) for i, bbox in bboxes.items()}
+                else:
+                    points = read_bboxes(bboxes, tile_index, extract_tiles_w_braces, cache=cache, verbose=verbose)
+                span.count(points_out=sum(len(p) for p in points.values()))
+            for i, (code, corners) in enumerate(batch):
+                if verbose: print('extracting feature:', code)
+                v = _extract_feature(code, corners, points.pop(i), out_dir, verbose, 
+                                     voxel_size=voxel_size, profiler=profiler)
 #         return v
 
-def _extract_feature(code, corners, tile_index, tile_path, out_dir, verbose):
+def feature_bbox(corners):
+
+    """
+    bounding box of points read around a marker
+    """
+
+    return [corners[['x', 'y', 'z']].min().values - [3, 3, 2], 
+            corners[['x', 'y', 'z']].max().values + [3, 3, 4]]
+
+def downsampled_dbscan(xyz, eps=.1, min_samples=25, voxel_size=None):
+
+    """
+    DBSCAN labels of points, if voxel_size is set points are clustered
+    by the centroids of the voxels they fall in, weighted by the number 
+    of points per voxel, and each point takes the label of its voxel
+
+    Parameters
+    ----------
+    xyz: np.array (N x 3)
+        point coordinates
+    eps: float (default .1)
+        DBSCAN eps
+    min_samples: int (default 25)
+        DBSCAN min_samples, counted in points not voxels
+    voxel_size: None or float (default None)
+        edge length of voxels, None clusters every point
+
+    Returns
+    -------
+    labels: np.array
+        cluster label of each point, -1 for noise
+    """
+
+    from sklearn.cluster import DBSCAN
+
+    xyz = np.asarray(xyz, dtype=np.float64)
+    if voxel_size is None or len(xyz) == 0:
+        return DBSCAN(eps=eps, min_samples=min_samples).fit(xyz).labels_
+
+    ijk = np.floor((xyz - xyz.min(axis=0)) / voxel_size).astype(np.int64)
+    keys = np.ravel_multi_index(ijk.T, ijk.max(axis=0) + 1)
+    _, inverse, count = np.unique(keys, return_inverse=True, return_counts=True)
+    inverse = inverse.ravel()
+    centroids = np.vstack([np.bincount(inverse, weights=xyz[:, i]) for i in range(3)]).T / count[:, np.newaxis]
+
+    labels = DBSCAN(eps=eps, min_samples=min_samples).fit(centroids, sample_weight=count).labels_
+    return labels[inverse]
+
+def _extract_feature(code, corners, voxel, out_dir, verbose, voxel_size=None, profiler=None):
     
+    profiler = as_profiler(profiler)
+    if len(voxel) == 0:
+        if verbose: print('    no points around marker')
+        return
     R = np.identity(4)
     R[:3, 3] = -corners[['x', 'y', 'z']].mean()
 
-    voxel = pd.DataFrame()
-    all_tiles = []
-   
-    # codes may overlap tiles so read in all tiles and append
-    for ix, cnr in corners.iterrows():
-        # extract tiles with a 10 m buffer
-        tile_names = tile_index.loc[np.where((np.isclose(cnr.y, tile_index.y, atol=10) & 
-                                              np.isclose(cnr.x, tile_index.x, atol=10)))].tile.values
-        for tile_name in tile_names:
-            if tile_name in all_tiles: continue
-            if verbose: print('        processing tile:', tile_name)
-            all_tiles.append(tile_name)
-            tile = read_pcd(tile_path.format(tile_name)) if tile_path.endswith('.pcd') else read_ply(tile_path.format(tile_name))
-            tile = tile.loc[(tile.x.between(corners.x.min() - 3, corners.x.max() + 3)) & 
-                            (tile.y.between(corners.y.min() - 3, corners.y.max() + 3)) &
-                            (tile.z.between(corners.z.min() - 2, corners.z.max() + 4))]
-            if len(tile) == 0: continue
-            # apply rotation
-            tile[['x', 'y', 'z']] = apply_rotation(R, tile)
-            # filter
-            tile = tile[(tile.z.between(0, 4)) &
-                        (tile.x.between(-1.5, 1.5)) &
-                        (tile.y.between(-2, 2))]
-            voxel = voxel.append(tile)    
-#             if verbose: print 'number of points extracted before clipping:', len(voxel)
+    with profiler.span('crop', points_in=len(voxel)) as span:
+        # apply rotation in place, float32 tiles stay float32
+        xyz = voxel[['x', 'y', 'z']].to_numpy(copy=True)
+        transform_points(R, xyz, out=xyz)
+        # filter
+        keep = (xyz[:, 2] >= 0) & (xyz[:, 2] <= 4) & \
+               (xyz[:, 0] >= -1.5) & (xyz[:, 0] <= 1.5) & \
+               (xyz[:, 1] >= -2) & (xyz[:, 1] <= 2)
+        voxel = voxel[keep]
+        voxel[['x', 'y', 'z']] = xyz[keep]
+        span.count(points_out=len(voxel))
+    if len(voxel) == 0:
+        if verbose: print('    no points around marker')
+        return
     
 #     return voxel
     if verbose: print('    total number of points for voxel:', len(voxel))
     if verbose: print('    running DBSCAN on voxel')
-    dbscan = DBSCAN(eps=.1, min_samples=25).fit(voxel[['x', 'y', 'z']])
-    print(dbscan.labels_)
-    voxel.loc[:, 'labels_'] = dbscan.labels_
-    voxel = voxel[voxel.labels_ != -1] 
-    voxel[['x', 'y', 'z']] = apply_rotation(np.linalg.inv(R), voxel)
+    with profiler.span('cluster', points_in=len(voxel)) as span:
+        labels = downsampled_dbscan(voxel[['x', 'y', 'z']].values, eps=.1, min_samples=25, voxel_size=voxel_size)
+        voxel.loc[:, 'labels_'] = labels
+        voxel = voxel[voxel.labels_ != -1] 
+        span.count(points_out=len(voxel), candidates=len(np.unique(labels[labels > -1])))
+    xyz = voxel[['x', 'y', 'z']].to_numpy(copy=True)
+    voxel[['x', 'y', 'z']] = transform_points(invert_transform(R), xyz, out=xyz)
     if verbose: print('    DBSCAN completed')
     
-    v = voxel.groupby('labels_').agg([min, max, 'count'])
+    v = voxel.groupby('labels_').agg(['min', 'max', 'count'])
+    if len(v) == 0:
+        if verbose: print('    no clusters found')
+        return
     stem_cluster = []
     inc = 0
     
@@ -95,5 +198,6 @@ def _extract_feature(code, corners, tile_index, tile_path, out_dir, verbose):
     if verbose: print('    finished incremeting')
     
     print('saving feature to:', os.path.join(out_dir, 'cluster_{}.pcd'.format(code)))
-    write_pcd(voxel[voxel.labels_.isin(stem_cluster)], 
-              os.path.join(out_dir, 'cluster_{}.pcd'.format(code)))  
+    with profiler.span('write', points_out=int(voxel.labels_.isin(stem_cluster).sum())):
+        write_pcd(voxel[voxel.labels_.isin(stem_cluster)], 
+                  os.path.join(out_dir, 'cluster_{}.pcd'.format(code)))  
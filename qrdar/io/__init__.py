@@ -1,2 +1,5 @@
-from pcd_io import *
-from ply_io import *
\ No newline at end of file
+from .pcd_io import *
+from .ply_io import *
+from .cache import *
+from .spatial_index import *
+from .batch import *
@@ -0,0 +1,90 @@
+import numpy as np
+
+from qrdar.io.stream import *
+from qrdar.io.pcd_io import *
+from qrdar.io.ply_io import *
+from qrdar.io.spatial_index import *
+
+def plan_tile_reads(bboxes, tile_index):
+
+    """
+    groups bounding boxes by the tiles they intersect
+
+    Parameters
+    ----------
+    bboxes: dict
+        {key: [[xmin, ymin, zmin], [xmax, ymax, zmax]]}
+    tile_index: pd.DataFrame or qrdar.io.TileIndex
+        tile index
+
+    Returns
+    -------
+    plan: dict
+        {tile: [keys of bboxes that intersect tile]}
+    """
+
+    tile_index = as_tile_index(tile_index)
+    plan = {}
+    for key, bbox in bboxes.items():
+        for tile in tile_index.query(bbox):
+            plan.setdefault(tile, []).append(key)
+
+    return plan
+
+def read_bboxes(bboxes, tile_index, filepath, fields=None, cache=None, 
+                chunk_size=1000000, verbose=False):
+
+    """
+    Reads the points within many bounding boxes from tiles, each 
+    tile is read once and points are scattered to every bounding box 
+    that needs them.
+
+    Parameters
+    ----------
+    bboxes: dict
+        {key: [[xmin, ymin, zmin], [xmax, ymax, zmax]]}
+    tile_index: pd.DataFrame or qrdar.io.TileIndex
+        tile index
+    filepath: str with {}
+        path to tiles where tile number is replaced with {} e.g. '../tiles/tile_{}.pcd'
+    fields: None or list (default None)
+        fields to read, x, y and z are always read. None reads all.
+    cache: None or qrdar.io.TileCache (default None)
+        cache to read tiles from
+    chunk_size: int (default 1e6)
+        number of points read at a time when there is no cache
+    verbose: boolean (default False)
+        print something
+
+    Returns
+    -------
+    points: dict
+        {key: pd.DataFrame}
+    """
+
+    if fields is not None:
+        fields = [ax for ax in ['x', 'y', 'z'] if ax not in fields] + list(fields)
+
+    bboxes = {k: np.asarray(v, dtype=float) for k, v in bboxes.items()}
+    plan = plan_tile_reads(bboxes, tile_index)
+    points = {k: [] for k in bboxes.keys()}
+
+    for tile, keys in plan.items():
+        
+        fp = filepath.format(tile)
+        if verbose: print('reading tile {} for {} bounding boxes'.format(tile, len(keys)))
+        # only points within the union of bounding boxes are kept
+        union = [np.min([bboxes[k][0] for k in keys], axis=0), 
+                 np.max([bboxes[k][1] for k in keys], axis=0)]
+
+        if cache is not None:
+            chunks = [cache.read(fp, bbox=union, fields=fields)]
+        else:
+            reader = iter_ply if fp.endswith('.ply') else iter_pcd
+            chunks = reader(fp, fields=fields, chunk_size=chunk_size, predicate=bbox_predicate(union))
+
+        for chunk in chunks:
+            for k in keys:
+                points[k].append(apply_predicate(chunk, bbox_predicate(bboxes[k])))
+
+    return {k: concat_frames(v, columns=fields) for k, v in points.items()}
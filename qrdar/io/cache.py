@@ -0,0 +1,177 @@
+import os
+import json
+import shutil
+import hashlib
+import numpy as np
+import pandas as pd
+
+from qrdar.io.stream import *
+from qrdar.io.pcd_io import *
+from qrdar.io.ply_io import *
+
+class TileCache(object):
+
+    """
+    Columnar on-disk cache of point cloud tiles. 
+    
+    Each tile is read once and written as one .npy per field with 
+    points sorted by a coarse voxel index, subsequent reads memory map 
+    the columns and only touch voxels that intersect the requested bbox. 
+    A tile is rebuilt when the size or modification time of the source
+    file changes.
+
+    Parameters
+    ----------
+    cache_dir: str
+        directory to store cached tiles, created if it does not exist
+    voxel_size: float (default 1.)
+        edge length of the voxels used to index points
+    """
+
+    def __init__(self, cache_dir, voxel_size=1.):
+
+        self.cache_dir = cache_dir
+        self.voxel_size = float(voxel_size)
+        if not os.path.isdir(cache_dir): os.makedirs(cache_dir)
+
+    def path(self, fp):
+
+        """ directory holding the cached version of fp """
+
+        fp = os.path.abspath(fp)
+        tag = hashlib.md5(fp.encode('utf-8')).hexdigest()[:8]
+        return os.path.join(self.cache_dir, '{}.{}'.format(os.path.basename(fp), tag))
+
+    def meta(self, fp):
+
+        """ metadata of the cached tile or None if not cached """
+
+        meta_path = os.path.join(self.path(fp), 'meta.json')
+        if not os.path.isfile(meta_path): return None
+        with open(meta_path) as fh:
+            return json.load(fh)
+
+    def is_valid(self, fp):
+
+        """ True if fp is cached and unchanged since caching """
+
+        meta = self.meta(fp)
+        if meta is None: return False
+        stat = os.stat(fp)
+        return meta['size'] == stat.st_size and meta['mtime'] == stat.st_mtime
+
+    def build(self, fp):
+
+        """
+        converts fp to the cached format, returns the metadata
+        """
+
+        stat = os.stat(fp)
+        pc = read_ply(fp) if fp.endswith('.ply') else read_pcd(fp)
+        xyz = pc[['x', 'y', 'z']].values
+
+        if len(pc) > 0:
+            bbox = np.array([xyz.min(axis=0), xyz.max(axis=0)])
+        else:
+            bbox = np.zeros((2, 3))
+        shape = (np.floor((bbox[1] - bbox[0]) / self.voxel_size) + 1).astype(int)
+        keys = self._keys(xyz, bbox[0], shape)
+        order = np.argsort(keys, kind='stable')
+        keys = keys[order]
+        voxels, starts = np.unique(keys, return_index=True)
+
+        # write to a temporary directory and move into place
+        out = self.path(fp)
+        tmp = out + '.tmp'
+        if os.path.isdir(tmp): shutil.rmtree(tmp)
+        os.makedirs(tmp)
+        for col in pc.columns:
+            np.save(os.path.join(tmp, '{}.npy'.format(col)), pc[col].values[order])
+        np.save(os.path.join(tmp, '_voxels.npy'), voxels)
+        np.save(os.path.join(tmp, '_starts.npy'), np.append(starts, len(keys)))
+
+        meta = {'source': os.path.abspath(fp), 'size': stat.st_size, 'mtime': stat.st_mtime,
+                'N': len(pc), 'fields': list(pc.columns), 'bbox': bbox.tolist(), 
+                'voxel_size': self.voxel_size, 'shape': shape.tolist()}
+        with open(os.path.join(tmp, 'meta.json'), 'w') as fh:
+            json.dump(meta, fh)
+
+        if os.path.isdir(out): shutil.rmtree(out)
+        os.rename(tmp, out)
+
+        return meta
+
+    def read(self, fp, bbox=None, fields=None):
+
+        """
+        Read points from a cached tile, the tile is (re)built if required
+
+        Parameters
+        ----------
+        fp: str
+            path to source tile (.pcd or .ply)
+        bbox: None or 2 x 3 array (default None)
+            [[xmin, ymin, zmin], [xmax, ymax, zmax]] of points to return,
+            None returns all points
+        fields: None or list (default None)
+            fields to return, None returns all
+
+        Returns
+        -------
+        pc: pd.DataFrame
+        """
+
+        meta = self.meta(fp) if self.is_valid(fp) else self.build(fp)
+        path = self.path(fp)
+        fields = meta['fields'] if fields is None else list(fields)
+        missing = [f for f in fields if f not in meta['fields']]
+        if len(missing) > 0:
+            raise KeyError('fields not found in file: {}'.format(missing))
+        columns = {f: np.load(os.path.join(path, '{}.npy'.format(f)), mmap_mode='r') 
+                   for f in set(fields) | set(['x', 'y', 'z'])}
+
+        if bbox is None:
+            return pd.DataFrame({f: np.array(columns[f]) for f in fields})
+
+        idx = self._candidates(path, meta, np.asarray(bbox, dtype=float))
+        mask = bbox_predicate(bbox)({ax: columns[ax][idx] for ax in ['x', 'y', 'z']})
+        idx = idx[mask]
+
+        return pd.DataFrame({f: np.array(columns[f][idx]) for f in fields})
+
+    def _keys(self, xyz, origin, shape):
+
+        ijk = np.floor((xyz - origin) / self.voxel_size).astype(np.int64)
+        ijk = np.clip(ijk, 0, shape - 1)
+        return np.ravel_multi_index(ijk.T, shape)
+
+    def _candidates(self, path, meta, bbox):
+
+        """ indices of points in voxels that intersect bbox """
+
+        origin, shape = np.array(meta['bbox'][0]), np.array(meta['shape'])
+        if meta['N'] == 0 or np.any(bbox[1] < origin) or np.any(bbox[0] > meta['bbox'][1]):
+            return np.array([], dtype=np.int64)
+
+        lo = np.clip(np.floor((bbox[0] - origin) / meta['voxel_size']), 0, shape - 1).astype(int)
+        hi = np.clip(np.floor((bbox[1] - origin) / meta['voxel_size']), 0, shape - 1).astype(int)
+        ijk = np.meshgrid(*[np.arange(l, h + 1) for l, h in zip(lo, hi)], indexing='ij')
+        keys = np.ravel_multi_index([i.ravel() for i in ijk], shape)
+
+        voxels = np.load(os.path.join(path, '_voxels.npy'), mmap_mode='r')
+        starts = np.load(os.path.join(path, '_starts.npy'), mmap_mode='r')
+        pos = np.searchsorted(voxels, keys)
+        keys, pos = keys[pos < len(voxels)], pos[pos < len(voxels)]
+        pos = pos[voxels[pos] == keys]
+        
+        return _ranges(starts[pos], starts[pos + 1])
+
+def _ranges(starts, ends):
+
+    """ concatenation of np.arange(s, e) for all s, e """
+
+    starts, ends = np.asarray(starts, dtype=np.int64), np.asarray(ends, dtype=np.int64)
+    lengths = ends - starts
+    if lengths.sum() == 0: return np.array([], dtype=np.int64)
+    offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+    return np.arange(lengths.sum()) + offsets
@@ -3,36 +3,187 @@ import argparse
 import numpy as np
 import pandas as pd
 
-def read_pcd(fp):
+from qrdar.io.stream import *
+
+# PCD TYPE and SIZE to numpy type
+pcd_types = {('F', 4): 'f4', ('F', 8): 'f8',
+             ('I', 1): 'i1', ('I', 2): 'i2', ('I', 4): 'i4', ('I', 8): 'i8',
+             ('U', 1): 'u1', ('U', 2): 'u2', ('U', 4): 'u4', ('U', 8): 'u8'}
+
+def read_pcd_header(fp):
+
+    """
+    Parses the header of a .pcd file without reading the body
+
+    Parameters
+    ----------
+    fp: str
+        path to .pcd
+
+    Returns
+    -------
+    header: dict
+        header entries plus 'offset' (bytes to start of data), 'lines'
+        (number of header lines) and 'N' (number of points)
+    """
+
+    header = {'lines': 0}
+
+    with open(fp, 'rb') as pcd:
+        while True:
+            line = pcd.readline()
+            if len(line) == 0:
+                raise ValueError('{} is not a valid .pcd, no DATA line'.format(fp))
+            header['lines'] += 1
+            line = line.decode('ISO-8859-1').strip()
+            if len(line) == 0 or line.startswith('#'): continue
+            key, values = line.split()[0], line.split()[1:]
+            header[key] = values
+            if key == 'DATA': break
+        header['offset'] = pcd.tell()
+
+    F = header['FIELDS']
+    header['SIZE'] = [int(s) for s in header.get('SIZE', ['4'] * len(F))]
+    header['TYPE'] = header.get('TYPE', ['F'] * len(F))
+    header['COUNT'] = [int(c) for c in header.get('COUNT', ['1'] * len(F))]
+    header['DATA'] = header['DATA'][0]
+    if 'POINTS' in header:
+        header['N'] = int(header['POINTS'][0])
+    else:
+        header['N'] = int(header['WIDTH'][0]) * int(header.get('HEIGHT', ['1'])[0])
+
+    return header
+
+def pcd_dtype(header):
+
+    """
+    numpy structured dtype of one point described by a .pcd header
+    """
+
+    dtype = []
+    for i, (f, s, t, c) in enumerate(zip(header['FIELDS'], header['SIZE'],
+                                         header['TYPE'], header['COUNT'])):
+        if f == '_': f = '_{}'.format(i) # padding, can be repeated
+        t = '<' + pcd_types[(t, s)]
+        dtype.append((f, t) if c == 1 else (f, t, (c,)))
+
+    return np.dtype(dtype)
+
+def memmap_pcd(fp, header=None):
+
+    """
+    Memory maps the body of a binary .pcd as a structured array,
+    no data is read until a field is accessed.
+
+    Parameters
+    ----------
+    fp: str
+        path to .pcd
+    header: None or dict (default None)
+        output from read_pcd_header, read if None
+
+    Returns
+    -------
+    arr: np.memmap
+        structured array with one record per point
+    """
+
+    if header is None:
+        header = read_pcd_header(fp)
+    if header['DATA'] != 'binary':
+        raise ValueError('only DATA binary can be memory mapped, {} is {}'.format(fp, header['DATA']))
+    if header['N'] == 0:
+        return np.empty(0, dtype=pcd_dtype(header))
+
+    return np.memmap(fp, dtype=pcd_dtype(header), mode='r',
+                     offset=header['offset'], shape=(header['N'],))
+
+def iter_pcd(fp, fields=None, chunk_size=1000000, predicate=None):
+
+    """
+    Iterates over a .pcd in chunks of chunk_size points
+
+    Parameters
+    ----------
+    fp: str
+        path to .pcd
+    fields: None or list (default None)
+        fields to read e.g. ['x', 'y', 'z', 'intensity'], None reads all
+    chunk_size: int (default 1e6)
+        number of points per chunk
+    predicate: None or callable (default None)
+        applied to each chunk before fields are selected, takes the chunk 
+        and returns a boolean array of points to keep 
+        e.g. lambda c: c['intensity'] >= 0
+
+    Yields
+    ------
+    chunk: pd.DataFrame
+    """
+
+    header = read_pcd_header(fp)
+
+    if header['DATA'] == 'binary':
+        dtype = pcd_dtype(header)
+        fields = select_fields(dtype, fields)
+        with open(fp, 'rb') as pcd:
+            pcd.seek(header['offset'])
+            for chunk in iter_records(pcd, dtype, header['N'], chunk_size):
+                yield to_frame(apply_predicate(chunk, predicate), fields)
+
+    elif header['DATA'] == 'ascii':
+        names = _ascii_columns(header)
+        for chunk in pd.read_csv(fp, sep=r'\s+', names=names, 
+                                 skiprows=header['lines'], nrows=header['N'],
+                                 chunksize=int(chunk_size)):
+            chunk = apply_predicate(chunk, predicate)
+            yield chunk if fields is None else chunk[list(fields)]
 
-    if (sys.version_info > (3, 0)):
-        open_file = open(fp, encoding='ISO-8859-1')
     else:
-        open_file = open(fp)
+        raise ValueError('DATA {} is not supported'.format(header['DATA']))
 
-    with open_file as pcd:
+def read_pcd(fp, fields=None, predicate=None, chunk_size=1000000):
 
-        length = 0
+    """
+    Read a .pcd, binary files are memory mapped and only fields that
+    are requested are copied into memory. Data types are as described
+    in the header.
 
-        for i, line in enumerate(pcd.readlines()):
-            length += len(line)
-            if 'WIDTH' in line: N = int(line.split()[1])
-            if 'FIELDS' in line: F = line.split()[1:]
-            if 'DATA' in line:
-                fmt = line.split()[1]
-                break
+    Parameters
+    ----------
+    fp: str
+        path to .pcd
+    fields: None or list (default None)
+        fields to read e.g. ['x', 'y', 'z', 'intensity'], None reads all
+    predicate: None or callable (default None)
+        filter applied chunk by chunk while reading so only points that
+        pass are held in memory e.g. lambda c: c['intensity'] >= 0
+    chunk_size: int (default 1e6)
+        number of points read at a time when predicate is set
 
-        if fmt == 'binary':
-            pcd.seek(length)
-            arr = np.fromfile(pcd, dtype='f')
+    Returns
+    -------
+    df: pd.DataFrame
+    """
+
+    header = read_pcd_header(fp)
+
+    if header['DATA'] == 'binary':
+        if predicate is None:
+            return to_frame(memmap_pcd(fp, header=header), fields)
+        empty = to_frame(np.empty(0, dtype=pcd_dtype(header)), fields)
+    else:
+        empty = pd.DataFrame(columns=_ascii_columns(header) if fields is None else fields)
 
-            arr = arr[:N*len(F)].reshape(-1, len(F))
-            df = pd.DataFrame(arr, columns=F)
+    chunks = list(iter_pcd(fp, fields=fields, chunk_size=chunk_size, predicate=predicate))
+    return concat_frames(chunks) if len(chunks) > 0 else empty
 
-    if fmt == 'ascii':
-        df = pd.read_csv(fp, sep=' ', names=F, skiprows=11)
+def _ascii_columns(header):
 
-    return df
+    names = []
+    for f, c in zip(header['FIELDS'], header['COUNT']):
+        names += [f] if c == 1 else ['{}_{}'.format(f, i) for i in range(c)]
+    return names
 
 def write_pcd(df, path, binary=True):
 
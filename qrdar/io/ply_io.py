@@ -1,42 +1,298 @@
 import pandas as pd
 import numpy as np
+import struct
 import sys
 
-def read_ply(fp):
-    
-    if (sys.version_info > (3, 0)):
-        open_file = open(fp, encoding='ISO-8859-1')
+from qrdar.io.stream import *
+
+# PLY property types to numpy type
+ply_types = {'char': 'i1', 'int8': 'i1', 'uchar': 'u1', 'uint8': 'u1',
+             'short': 'i2', 'int16': 'i2', 'ushort': 'u2', 'uint16': 'u2',
+             'int': 'i4', 'int32': 'i4', 'uint': 'u4', 'uint32': 'u4',
+             'float': 'f4', 'float32': 'f4', 'double': 'f8', 'float64': 'f8'}
+
+ply_byteorder = {'binary_little_endian': '<', 'binary_big_endian': '>', 'ascii': '='}
+
+def read_ply_header(fp):
+
+    """
+    Parses the header of a .ply without reading the body
+
+    Parameters
+    ----------
+    fp: str
+        path to .ply
+
+    Returns
+    -------
+    header: dict
+        'format', 'elements' (list of dicts with 'name', 'count' and
+        'properties'), 'offset' (bytes to start of data) and 'lines'
+        (number of header lines). List properties are stored as
+        (name, count_type, item_type) and scalars as (name, type)
+    """
+
+    header = {'elements': [], 'comments': [], 'lines': 0}
+
+    with open(fp, 'rb') as ply:
+        for line in iter(ply.readline, b''):
+            header['lines'] += 1
+            line = line.decode('ISO-8859-1').split()
+            if len(line) == 0: continue
+            if line[0] == 'format':
+                header['format'] = line[1]
+            elif line[0] in ['comment', 'obj_info']:
+                header['comments'].append(' '.join(line[1:]))
+            elif line[0] == 'element':
+                header['elements'].append({'name': line[1], 'count': int(line[2]), 'properties': []})
+            elif line[0] == 'property' and line[1] == 'list':
+                header['elements'][-1]['properties'].append((line[4], line[2], line[3]))
+            elif line[0] == 'property':
+                header['elements'][-1]['properties'].append((line[2], line[1]))
+            elif line[0] == 'end_header':
+                break
+        else:
+            raise ValueError('{} is not a valid .ply, no end_header'.format(fp))
+        header['offset'] = ply.tell()
+
+    if header.get('format') not in ply_byteorder:
+        raise ValueError('unknown .ply format: {}'.format(header.get('format')))
+
+    return header
+
+def ply_dtype(element, fmt='binary_little_endian', list_length=None):
+
+    """
+    numpy structured dtype of one row of a .ply element. Elements 
+    with list properties only have a fixed size dtype if every list
+    is the same length, this is passed as list_length.
+    """
+
+    bo = ply_byteorder[fmt]
+    dtype = []
+    for p in element['properties']:
+        if len(p) == 2:
+            dtype.append((p[0], bo + ply_types[p[1]]))
+        elif list_length is None:
+            return None
+        else:
+            dtype.append((p[0] + '_count', bo + ply_types[p[1]]))
+            dtype.append((p[0], bo + ply_types[p[2]], (list_length,)))
+
+    return np.dtype(dtype)
+
+def memmap_ply(fp, element='vertex', header=None):
+
+    """
+    Memory maps an element of a binary .ply as a structured array,
+    no data is read until a field is accessed. Big endian data is 
+    mapped as is and converted when fields are copied out.
+
+    Parameters
+    ----------
+    fp: str
+        path to .ply
+    element: str (default 'vertex')
+        name of element
+    header: None or dict (default None)
+        output from read_ply_header, read if None
+
+    Returns
+    -------
+    arr: np.memmap
+        structured array with one record per element row
+    """
+
+    if header is None:
+        header = read_ply_header(fp)
+    if header['format'] == 'ascii':
+        raise ValueError('ascii .ply can not be memory mapped')
+
+    offset, el = _element_offset(fp, header, element)
+    dtype = _element_dtype(fp, header, el, offset)
+    if dtype is None:
+        raise ValueError('element {} has variable length lists and can not be mapped'.format(element))
+    if el['count'] == 0:
+        return np.empty(0, dtype=dtype)
+
+    return np.memmap(fp, dtype=dtype, mode='r', offset=offset, shape=(el['count'],))
+
+def iter_ply(fp, element='vertex', fields=None, chunk_size=1000000, predicate=None):
+
+    """
+    Iterates over an element of a .ply in chunks of chunk_size rows
+
+    Parameters
+    ----------
+    fp: str
+        path to .ply
+    element: str (default 'vertex')
+        name of element
+    fields: None or list (default None)
+        properties to read e.g. ['x', 'y', 'z', 'intensity'], None reads all
+    chunk_size: int (default 1e6)
+        number of rows per chunk
+    predicate: None or callable (default None)
+        applied to each chunk before fields are selected, takes the chunk 
+        and returns a boolean array of rows to keep 
+        e.g. lambda c: c['intensity'] >= 0
+
+    Yields
+    ------
+    chunk: pd.DataFrame
+    """
+
+    header = read_ply_header(fp)
+
+    if header['format'] == 'ascii':
+        skip, el = header['lines'], None
+        for e in header['elements']:
+            if e['name'] == element: 
+                el = e
+                break
+            skip += e['count']
+        if el is None:
+            raise KeyError('element {} not found in {}'.format(element, fp))
+        if ply_dtype(el, 'ascii') is None:
+            raise ValueError('list properties are not supported for ascii .ply')
+        names = [p[0] for p in el['properties']]
+        for chunk in pd.read_csv(fp, sep=r'\s+', names=names, skiprows=skip, 
+                                 nrows=el['count'], chunksize=int(chunk_size)):
+            chunk = apply_predicate(chunk, predicate)
+            yield chunk if fields is None else chunk[list(fields)]
+
+    else:
+        offset, el = _element_offset(fp, header, element)
+        dtype = _element_dtype(fp, header, el, offset)
+        if dtype is None:
+            raise ValueError('element {} has variable length lists and can not be read'.format(element))
+        fields = select_fields(dtype, fields)
+        with open(fp, 'rb') as ply:
+            ply.seek(offset)
+            for chunk in iter_records(ply, dtype, el['count'], chunk_size):
+                yield to_frame(apply_predicate(chunk, predicate), fields)
+
+def read_ply(fp, fields=None, predicate=None, chunk_size=1000000, element='vertex'):
+
+    """
+    Read an element of a .ply (binary little / big endian or ascii). 
+    Binary files are memory mapped and only fields that are requested 
+    are copied into memory.
+
+    Elements with variable length lists (e.g. faces) that come before
+    element in the file are walked over row by row to find where 
+    element starts, this is slow for large meshes.
+
+    Parameters
+    ----------
+    fp: str
+        path to .ply
+    fields: None or list (default None)
+        properties to read e.g. ['x', 'y', 'z', 'intensity'], None reads all
+    predicate: None or callable (default None)
+        filter applied chunk by chunk while reading so only points that
+        pass are held in memory e.g. lambda c: c['intensity'] >= 0
+    chunk_size: int (default 1e6)
+        number of points read at a time when predicate is set
+    element: str (default 'vertex')
+        name of element to read
+
+    Returns
+    -------
+    df: pd.DataFrame
+    """
+
+    header = read_ply_header(fp)
+
+    if header['format'] != 'ascii':
+        arr = memmap_ply(fp, element=element, header=header)
+        if predicate is None:
+            return to_frame(arr, fields)
+        empty = to_frame(arr[:0], fields)
     else:
-        open_file = open(fp)
-
-    with open_file as ply:
- 
-        length = 0
-        prop = []
-        dtype_map = {'float': 'f4', 'uchar': 'B', 'int':'i'}
-        dtype = []
-        fmt = 'binary'
-    
-        for i, line in enumerate(ply.readlines()):
-            length += len(line)
-            if i == 0:
-                if 'ascii' in line:
-                    fmt = 'ascii' 
-            if 'element vertex' in line: N = int(line.split()[2])
-            if 'property' in line: 
-                dtype.append(dtype_map[line.split()[1]])
-                prop.append(line.split()[2])
-            if 'end_header' in line: break
-    
-        ply.seek(length)
-        if fmt == 'binary':
-            arr = np.fromfile(ply, dtype=','.join(dtype))
+        empty = pd.DataFrame()
+
+    chunks = list(iter_ply(fp, element=element, fields=fields, 
+                           chunk_size=chunk_size, predicate=predicate))
+    return concat_frames(chunks) if len(chunks) > 0 else empty
+
+def _element_offset(fp, header, element):
+
+    """
+    byte offset to the start of element, elements with list 
+    properties that come before are walked over
+    """
+
+    offset = header['offset']
+    for el in header['elements']:
+        if el['name'] == element:
+            return offset, el
+        dtype = _element_dtype(fp, header, el, offset)
+        if dtype is not None:
+            offset += dtype.itemsize * el['count']
         else:
-            arr = pd.read_csv(ply, sep=' ')
-        df = pd.DataFrame(arr)
-        df.columns = prop
-        
-    return df
+            offset = _skip_element(fp, header, el, offset)
+
+    raise KeyError('element {} not found in {}'.format(element, fp))
+
+def _element_dtype(fp, header, el, offset):
+
+    """
+    dtype of an element, if the element has list properties the
+    length of the first list is read and used if all lists match
+    """
+
+    dtype = ply_dtype(el, header['format'])
+    if dtype is not None or el['count'] == 0:
+        return dtype if dtype is not None else ply_dtype(el, header['format'], 0)
+
+    # find length of first list and check it is constant
+    bo = ply_byteorder[header['format']]
+    lists = [i for i, p in enumerate(el['properties']) if len(p) == 3]
+    if len(lists) > 1: return None
+    prefix = ply_dtype({'properties': el['properties'][:lists[0]]}, header['format'])
+    count_type = np.dtype(bo + ply_types[el['properties'][lists[0]][1]])
+    with open(fp, 'rb') as ply:
+        ply.seek(offset + prefix.itemsize)
+        n = int(np.fromfile(ply, dtype=count_type, count=1)[0])
+    dtype = ply_dtype(el, header['format'], list_length=n)
+    arr = np.memmap(fp, dtype=dtype, mode='r', offset=offset, shape=(el['count'],))
+    if not np.all(arr[el['properties'][lists[0]][0] + '_count'] == n):
+        return None
+
+    return dtype
+
+def _skip_element(fp, header, el, offset):
+
+    """
+    walks over an element with variable length lists returning
+    the offset to the byte after it. Rows have to be walked one at
+    a time but list lengths are unpacked from a memory map rather
+    than read from the file
+    """
+
+    bo = ply_byteorder[header['format']]
+
+    # runs of fixed size properties are skipped in one step, each list
+    # is (bytes before it, count format, count size, item size)
+    lists, fixed = [], 0
+    for p in el['properties']:
+        if len(p) == 2:
+            fixed += np.dtype(ply_types[p[1]]).itemsize
+        else:
+            count = np.dtype(ply_types[p[1]])
+            lists.append((fixed, bo + count.char, count.itemsize, np.dtype(ply_types[p[2]]).itemsize))
+            fixed = 0
+
+    buf = np.memmap(fp, dtype='u1', mode='r', offset=offset)
+    pos = 0
+    for i in range(el['count']):
+        for before, fmt, size, item in lists:
+            pos += before
+            pos += size + struct.unpack_from(fmt, buf, pos)[0] * item
+        pos += fixed
+
+    return offset + pos
 
 def write_ply(output_name, pc):
 
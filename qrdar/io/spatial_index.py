@@ -0,0 +1,202 @@
+import numpy as np
+import pandas as pd
+
+class TileIndex(object):
+
+    """
+    Grid hashed spatial index of tile extents, answers which tiles
+    intersect a bounding box without scanning every tile.
+
+    Parameters
+    ----------
+    tile_index: pd.DataFrame
+        either tile centres with fields ['tile', 'x', 'y'] or tile extents 
+        with fields ['tile', 'xmin', 'xmax', 'ymin', 'ymax']. 'tile_number'
+        is also accepted in place of 'tile'.
+    tile_size: None or float (default None)
+        edge length of tiles when tile centres are given, if None it is
+        the spacing between tile centres (10 if there is one tile)
+    """
+
+    def __init__(self, tile_index, tile_size=None):
+
+        name = 'tile' if 'tile' in tile_index.columns else 'tile_number'
+        self.tiles = tile_index[name].to_numpy()
+
+        if 'xmin' in tile_index.columns:
+            self.extents = tile_index[['xmin', 'ymin', 'xmax', 'ymax']].values.astype(float)
+        else:
+            centres = tile_index[['x', 'y']].values.astype(float)
+            if tile_size is None: tile_size = tile_spacing(centres)
+            self.extents = np.hstack([centres - tile_size / 2., centres + tile_size / 2.])
+
+        # hash tiles into cells the size of the largest tile
+        self.cell = max(np.max(self.extents[:, 2:] - self.extents[:, :2]), 1e-6) if len(self) > 0 else 1.
+        self.grid = {}
+        lo, hi = self._cells(self.extents[:, :2]), self._cells(self.extents[:, 2:])
+        for t, (l, h) in enumerate(zip(lo, hi)):
+            for i in range(l[0], h[0] + 1):
+                for j in range(l[1], h[1] + 1):
+                    self.grid.setdefault((i, j), []).append(t)
+
+    def __len__(self):
+
+        return len(self.tiles)
+
+    def _cells(self, xy):
+
+        return np.floor(np.asarray(xy) / self.cell).astype(int)
+
+    def query(self, bbox):
+
+        """
+        tiles that intersect bbox
+
+        Parameters
+        ----------
+        bbox: 2 x 2 or 2 x 3 array
+            [[xmin, ymin, (zmin)], [xmax, ymax, (zmax)]], z is ignored
+
+        Returns
+        -------
+        tiles: np.array
+            tile names in the order they appear in the tile index
+        """
+
+        bbox = np.asarray(bbox, dtype=float)[:, :2]
+        l, h = self._cells(bbox[0]), self._cells(bbox[1])
+        candidates = set()
+        for i in range(l[0], h[0] + 1):
+            for j in range(l[1], h[1] + 1):
+                candidates.update(self.grid.get((i, j), []))
+        candidates = np.array(sorted(candidates), dtype=int)
+        if len(candidates) == 0: 
+            return self.tiles[:0]
+
+        ext = self.extents[candidates]
+        hit = np.all(ext[:, :2] <= bbox[1], axis=1) & np.all(ext[:, 2:] >= bbox[0], axis=1)
+
+        return self.tiles[candidates[hit]]
+
+def tile_spacing(centres, default=10.):
+
+    """
+    smallest distance between tile centres along x or y, default
+    if there is only one tile
+    """
+
+    centres = np.asarray(centres, dtype=float)
+    steps = [np.diff(np.unique(np.round(centres[:, i], 6))) for i in range(2)]
+    steps = np.hstack(steps)
+    steps = steps[steps > 0]
+    return steps.min() if len(steps) > 0 else default
+
+def as_tile_index(tile_index, tile_size=None):
+
+    """
+    returns tile_index as a TileIndex, building one if a
+    pd.DataFrame is passed, see TileIndex for tile_size
+    """
+
+    if isinstance(tile_index, TileIndex):
+        return tile_index
+
+    return TileIndex(tile_index, tile_size=tile_size)
+
+class PointIndex(object):
+
+    """
+    Grid hashed spatial index of a point cloud, built once and then
+    queried for the points within a bounding box. Points are ordered by
+    their x, y cell so each row of cells in a box is a single slice of
+    the ordering, only points in those slices are compared with the box.
+
+    Parameters
+    ----------
+    pc: pd.DataFrame or np.array
+        point cloud with fields ['x', 'y', 'z'] or an N x 3 array, the 
+        coordinates are referenced not copied
+    cell: float (default 1)
+        edge length of grid cells
+    """
+
+    def __init__(self, pc, cell=1.):
+
+        if isinstance(pc, pd.DataFrame):
+            self.xyz = [pc[c].to_numpy() for c in ['x', 'y', 'z']]
+        else:
+            self.xyz = [np.asarray(pc)[:, i] for i in range(3)]
+        self.cell = float(cell)
+
+        ij = np.vstack([np.floor(c / self.cell) for c in self.xyz[:2]]).astype(np.int64)
+        self.origin = ij.min(axis=1) if len(self) > 0 else np.zeros(2, dtype=np.int64)
+        ij -= self.origin[:, np.newaxis]
+        self.n_cols, self.n_rows = ij.max(axis=1) + 1 if len(self) > 0 else (1, 1)
+        keys = ij[0] * self.n_rows + ij[1]
+        del ij
+
+        # only occupied cells are stored
+        self.order = np.argsort(keys, kind='stable').astype(np.int32 if len(self) < 2**31 else np.int64)
+        self.keys, self.start = np.unique(keys[self.order], return_index=True)
+        self.start = np.append(self.start, len(self))
+
+    def __len__(self):
+
+        return len(self.xyz[0])
+
+    def slices(self, bbox):
+
+        """
+        slices of self.order that contain every point in bbox, one per 
+        row of cells
+        """
+
+        bbox = np.asarray(bbox, dtype=float)
+        lo = np.floor(bbox[0, :2] / self.cell).astype(np.int64) - self.origin
+        hi = np.floor(bbox[1, :2] / self.cell).astype(np.int64) - self.origin
+        lo, hi = np.maximum(lo, 0), np.minimum(hi, [self.n_cols - 1, self.n_rows - 1])
+        if np.any(hi < lo): return []
+
+        rows = np.arange(lo[0], hi[0] + 1) * self.n_rows
+        first = np.searchsorted(self.keys, rows + lo[1], side='left')
+        last = np.searchsorted(self.keys, rows + hi[1], side='right')
+        return [slice(self.start[f], self.start[l]) for f, l in zip(first, last) if l > f]
+
+    def query(self, bbox):
+
+        """
+        positions of the points within bbox (inclusive)
+
+        Parameters
+        ----------
+        bbox: 2 x 3 array
+            [[xmin, ymin, zmin], [xmax, ymax, zmax]]
+
+        Returns
+        -------
+        idx: np.array
+            ascending positions of points in the point cloud, use with 
+            pc.iloc or pc.take
+        """
+
+        bbox = np.asarray(bbox, dtype=float)
+        slices = self.slices(bbox)
+        if len(slices) == 0: return np.array([], dtype=np.intp)
+        idx = np.hstack([self.order[s] for s in slices])
+        
+        inside = np.ones(len(idx), dtype=bool)
+        for c, coord in enumerate(self.xyz):
+            v = coord[idx]
+            inside &= (v >= bbox[0, c]) & (v <= bbox[1, c])
+        return np.sort(idx[inside])
+
+    def crop(self, pc, bbox, fields=None):
+
+        """
+        points of pc (the point cloud the index was built from) within bbox
+        """
+
+        if len(pc) != len(self):
+            raise ValueError('pc has {} points, the index was built from {}'.format(len(pc), len(self)))
+        pc = pc.iloc[self.query(bbox)]
+        return pc if fields is None else pc[fields]
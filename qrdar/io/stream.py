@@ -0,0 +1,116 @@
+import numpy as np
+import pandas as pd
+
+
+def select_fields(dtype, fields=None):
+
+    """
+    returns the names of fields in a structured dtype that should
+    be returned, padding fields (starting with '_') are dropped
+    """
+
+    if fields is None:
+        return [f for f in dtype.names if not f.startswith('_')]
+
+    missing = [f for f in fields if f not in dtype.names]
+    if len(missing) > 0:
+        raise KeyError('fields not found in file: {}'.format(missing))
+
+    return list(fields)
+
+
+def to_frame(arr, fields=None):
+
+    """
+    copies the requested fields of a structured array (or a view
+    of a memory-mapped file) into a DataFrame. Fields with
+    COUNT > 1 are split into name_0, name_1 ...
+    """
+
+    columns = {}
+    for f in select_fields(arr.dtype, fields):
+        col = arr[f]
+        dtype = col.dtype.newbyteorder('=')
+        if col.ndim == 1:
+            columns[f] = np.array(col, dtype=dtype)
+        else:
+            for i in range(col.shape[1]):
+                columns['{}_{}'.format(f, i)] = np.array(col[:, i], dtype=dtype)
+
+    return pd.DataFrame(columns)
+
+
+def concat_frames(frames, columns=None):
+
+    """
+    concatenates DataFrames with the same columns into one, each column
+    is preallocated and filled in a single pass so the cost is linear 
+    in the number of points. columns is used if frames is empty
+    """
+
+    frames = [f for f in frames if len(f) > 0] or frames[:1]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=columns)
+    if len(frames) == 1:
+        return frames[0].reset_index(drop=True)
+
+    N = sum(len(f) for f in frames)
+    out = {}
+    for c in frames[0].columns:
+        col = np.empty(N, dtype=np.result_type(*[f[c].dtype for f in frames]))
+        i = 0
+        for f in frames:
+            col[i:i + len(f)] = f[c].to_numpy()
+            i += len(f)
+        out[c] = col
+
+    return pd.DataFrame(out)
+
+
+def iter_records(fh, dtype, N, chunk_size):
+
+    """
+    reads N records of dtype from an open binary file in chunks of
+    chunk_size. Unlike iterating over a memory map, pages are not
+    kept resident so memory is bounded by the chunk size
+    """
+
+    chunk_size = max(int(chunk_size), 1)
+    while N > 0:
+        chunk = np.fromfile(fh, dtype=dtype, count=min(chunk_size, N))
+        if len(chunk) == 0: break
+        N -= len(chunk)
+        yield chunk
+
+
+def apply_predicate(chunk, predicate):
+
+    """
+    filters a chunk (structured array or DataFrame) with predicate,
+    a callable that takes the chunk and returns a boolean array
+    e.g. lambda c: c['intensity'] > 0
+    """
+
+    if predicate is None:
+        return chunk
+
+    return chunk[np.asarray(predicate(chunk), dtype=bool)]
+
+
+def bbox_predicate(bbox):
+
+    """
+    predicate selecting points within bbox where bbox is
+    [[xmin, ymin, zmin], [xmax, ymax, zmax]] (inclusive)
+    """
+
+    bbox = np.asarray(bbox, dtype=float)
+
+    def predicate(c):
+        mask = True
+        for i, ax in enumerate(['x', 'y', 'z']):
+            v = np.asarray(c[ax])
+            mask = mask & (v >= bbox[0, i]) & (v <= bbox[1, i])
+        return mask
+
+    return predicate
@@ -1,15 +1,23 @@
+import os
+import functools
 import pandas as pd
 import numpy as np
+from concurrent.futures import ProcessPoolExecutor
 
 from qrdar.common import * 
+from qrdar.profiling import as_profiler, run_profiled
 
 def locateTargets(pc, markerTemplate=None, min_intensity=0, rmse_threshold=.15, 
-                  check_z=True, verbose=False):
+                  check_z=True, verbose=False, profiler=None, n_jobs=1, return_targets=False):
 
     """ 
     Groups stickers into potential targets, this is required for
     the next stage
 
+    Sticker centres are clustered once and each cluster is then 
+    resolved independently, clusters with more than 4 stickers are
+    split into targets that fit the template.
+
     Parameters
     ----------
     potential_dots: pd.DataFrame
@@ -18,13 +26,39 @@ def locateTargets(pc, markerTemplate=None, min_intensity=0, rmse_threshold=.15,
         assumes targets are upright and removes otherwise
     verbose: boolean (default False)
         print something
+    profiler: None or qrdar.profiling.Profiler (default None)
+        records a 'locateTargets' span and a 'resolve' span per cluster
+        with the number of stickers and template combinations tried
+    n_jobs: int (default 1)
+        number of worker processes used to resolve clusters, -1 uses 
+        all cores
+    return_targets: boolean (default False)
+        also return the per target record, pass this to readCodes as 
+        targets so stickers are not matched to the template again
 
     Returns
     -------
     code_centre: pd.DataFrame
         locatin of potential targets
+    targets: pd.DataFrame
+        if return_targets, one row per target_labels_ with the sticker 
+        labels of the target (stickers) and those that fit the template
+        (idx), the 4 x 4 transform from stickers to template (R), rmse
+        and the bounding box of the sticker centres (xmin, ymin, zmin, 
+        xmax, ymax, zmax)
     """
     
+    profiler = as_profiler(profiler)
+    with profiler.span('locateTargets', points_in=len(pc)) as span:
+        pc, targets = _locate_targets(pc, markerTemplate, check_z, n_jobs, profiler, verbose)
+        span.count(points_out=len(pc), targets=len(targets))
+
+    if return_targets:
+        return pc, targets
+    return pc
+
+def _locate_targets(pc, markerTemplate, check_z, n_jobs, profiler, verbose):
+
     if 'target_labels_' in pc.columns:
         del pc['target_labels_']
         
@@ -34,55 +68,45 @@ def locateTargets(pc, markerTemplate=None, min_intensity=0, rmse_threshold=.15,
     # cluster pc into potential dots
     potential_dots = pc.groupby('sticker_labels_').mean().reset_index()
 
+    from sklearn.cluster import DBSCAN
+
     # target_centre = pc.loc[pc.labels_.isin(potential_dots.index)].groupby('labels_').mean()
     dbscan = DBSCAN(eps=.4, min_samples=3).fit(potential_dots[['x', 'y', 'z']])
     potential_dots.loc[:, 'target_labels_'] = dbscan.labels_
     potential_dots = potential_dots[potential_dots.target_labels_ != -1]
     if verbose: print('number of potential targets:', len(potential_dots.target_labels_.unique()))
     
-    # check if targets are too close
-    while np.any(~potential_dots.target_labels_.value_counts().isin([3, 4])):
-        
-        for labels in potential_dots.target_labels_.unique():
-            
-            remove = False
-            bright_spots_tmp = potential_dots[potential_dots.target_labels_ == labels]
-            if verbose: print('processing: {} (number of stickers {})'.format(labels, len(bright_spots_tmp)))
-            
-            # remove stickers that don't match ~ distance between stickers
-            remove_idx = distanceFilter(bright_spots_tmp, markerTemplate)
-            potential_dots = potential_dots.loc[~potential_dots.index.isin(remove_idx)]
-            bright_spots_tmp = bright_spots_tmp.loc[~bright_spots_tmp.index.isin(remove_idx)]
-            if len(remove_idx) > 0:
-                if verbose: print("\tstickers removed for wrong distance:", len(remove_idx))
-            
-            if len(bright_spots_tmp) < 3:
-                reason = 'less than 3'
-                remove = True
-            
-            if len(bright_spots_tmp) > 4:
-                idx, R, rmse = calculate_R(bright_spots_tmp, markerTemplate)
-                if np.isnan(rmse):
-                    reason = 'does not fit template'
-                    remove = True
-                else:
-                    labels = potential_dots.target_labels_.max() + 1
-                    bright_spots_tmp = bright_spots_tmp.loc[idx]
-                    potential_dots.loc[idx, 'target_labels_'] = labels
-            
-            if 3 <= len(bright_spots_tmp) <= 4:
-                if check_z:
-                    if np.ptp(bright_spots_tmp.z) < .1 or np.ptp(bright_spots_tmp.z) > .4:
-                        reason = 'points are not spread over Z correctly' 
-                        remove = True
-                idx, R, rmse = calculate_R(bright_spots_tmp, markerTemplate)
-                if np.isnan(rmse):
-                    reason = 'rmse greater than threshold'
-                    remove = True
+    # resolve each cluster independently
+    clusters = [(label, dots[['x', 'y', 'z']].copy()) 
+                for label, dots in potential_dots.groupby('target_labels_')]
+    resolve = functools.partial(_resolve_cluster, markerTemplate=markerTemplate, 
+                                check_z=check_z, verbose=verbose)
+    if n_jobs != 1 and len(clusters) > 1:
+        n_jobs = os.cpu_count() if n_jobs < 1 else n_jobs
+        if profiler: resolve = functools.partial(run_profiled, resolve, profiler.memory)
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            resolved = list(pool.map(resolve, *zip(*clusters), 
+                                     chunksize=max(1, len(clusters) // (4 * n_jobs))))
+        if profiler:
+            for targets, records in resolved: profiler.merge(records)
+            resolved = [targets for targets, records in resolved]
+    else:
+        resolved = [resolve(*c, profiler=profiler) for c in clusters]
 
-            if remove:
-                if verbose: print("\tremvoing targets labelled: {} {}".format(labels, reason))
-                potential_dots = potential_dots[potential_dots.target_labels_ != labels]
+    # label targets in one batch and keep the transform of each
+    index, labels, records = [], [], []
+    sticker_labels = potential_dots.sticker_labels_
+    for t, target in enumerate([t for targets in resolved for t in targets]):
+        index += target['stickers']
+        labels += [t] * len(target['stickers'])
+        xyz = potential_dots.loc[target['stickers'], ['x', 'y', 'z']].values
+        records.append([tuple(sticker_labels.loc[target['stickers']]), tuple(sticker_labels.loc[target['idx']]),
+                        target['R'], target['rmse']] + list(xyz.min(axis=0)) + list(xyz.max(axis=0)))
+    potential_dots = potential_dots.loc[index]
+    potential_dots.loc[:, 'target_labels_'] = labels
+    targets = pd.DataFrame(records, columns=['stickers', 'idx', 'R', 'rmse', 
+                                             'xmin', 'ymin', 'zmin', 'xmax', 'ymax', 'zmax'])
+    targets.index.name = 'target_labels_'
     
     # find code centres
     code_centres = potential_dots.groupby('target_labels_')[['x', 'y', 'z']].mean().reset_index()
@@ -90,4 +114,57 @@ def locateTargets(pc, markerTemplate=None, min_intensity=0, rmse_threshold=.15,
 
     pc = pd.merge(pc, potential_dots[['sticker_labels_', 'target_labels_']],  on='sticker_labels_', how='right')
 
-    return pc
+    return pc, targets
+
+def _resolve_cluster(labels, dots, markerTemplate=None, check_z=True, profiler=None, verbose=False):
+
+    """
+    splits a cluster of sticker centres into targets that fit 
+    markerTemplate. Each pass either removes the cluster or takes at 
+    least 3 stickers from it so the number of passes is bounded.
+
+    Returns
+    -------
+    targets: list of dicts
+        'stickers' (index of dots in the target), 'idx' (index of dots
+        that fit the template), 'R' (4 x 4 transform) and 'rmse'
+    """
+
+    targets = []
+    with as_profiler(profiler).span('resolve', stickers=len(dots)) as span:
+
+        while len(dots) > 0:
+
+            if verbose: print('processing: {} (number of stickers {})'.format(labels, len(dots)))
+        
+            # remove stickers that don't match ~ distance between stickers
+            remove_idx = distanceFilter(dots, markerTemplate)
+            dots = dots.loc[~dots.index.isin(remove_idx)]
+            if len(remove_idx) > 0:
+                if verbose: print("\tstickers removed for wrong distance:", len(remove_idx))
+        
+            if len(dots) < 3:
+                if verbose: print("\tremvoing targets labelled: {} {}".format(labels, 'less than 3'))
+                break
+
+            if len(dots) > 4:
+                # split off stickers that fit the template and carry on with the rest
+                idx, R, rmse = calculate_R(dots, markerTemplate, counters=span.counters)
+                if np.isnan(rmse):
+                    if verbose: print("\tremvoing targets labelled: {} {}".format(labels, 'does not fit template'))
+                    break
+                target, dots = dots.loc[idx], dots.loc[~dots.index.isin(idx)]
+            else:
+                target, dots = dots, dots.iloc[:0]
+                idx, R, rmse = calculate_R(target, markerTemplate, counters=span.counters)
+        
+            if check_z and (np.ptp(target.z) < .1 or np.ptp(target.z) > .4):
+                if verbose: print("\tremvoing targets labelled: {} {}".format(labels, 'points are not spread over Z correctly'))
+            elif np.isnan(rmse):
+                if verbose: print("\tremvoing targets labelled: {} {}".format(labels, 'rmse greater than threshold'))
+            else:
+                targets.append({'stickers': list(target.index), 'idx': idx, 'R': R, 'rmse': rmse})
+
+        span.count(targets=len(targets))
+
+    return targets
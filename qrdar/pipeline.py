@@ -0,0 +1,371 @@
+import os
+import glob
+import json
+import functools
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor
+
+from qrdar.io.pcd_io import *
+from qrdar.io.ply_io import *
+from qrdar.io.spatial_index import *
+
+def process_tiles(tiles,
+                  out_dir,
+                  tiles_w_braces=None,
+                  refl_field='intensity',
+                  min_intensity=5,
+                  sticker_size=.025,
+                  halo=2.,
+                  check_z=True,
+                  expected_codes=[],
+                  codes_dict='aruco_mip_16h3',
+                  extract_tiles_w_braces=None,
+                  voxel_size=None,
+                  cache=None,
+                  chunk_size=1000000,
+                  n_jobs=1,
+                  resume=True,
+                  verbose=False):
+
+    """
+    Runs the full pipeline over a tiled plot: the bright points of each
+    tile are streamed from disk, stickers and targets are found per tile,
+    targets are merged across tiles, codes are read and (optionally)
+    features extracted.
+
+    Only the bright points of a tile and its neighbours are held in
+    memory at any time. Each stage writes a checkpoint to out_dir (per
+    tile for the first two stages) so an interrupted run continues where
+    it stopped when rerun with resume=True.
+
+    Parameters
+    ----------
+    tiles: str or pd.DataFrame
+        either a directory of .ply or .pcd tiles or a tile index with
+        field 'tile' (or 'tile_number'), in which case tiles_w_braces
+        is required. A path to a .csv tile index is also accepted.
+    out_dir: str
+        directory for checkpoints and output, created if it does not exist
+    tiles_w_braces: None or str (default None)
+        path to tiles where tile number is replaced with {}
+        e.g. '../tiles/tile_{}.pcd', not required when tiles is a directory
+    refl_field: str (default 'intensity')
+        field containing reflectance / intensity values
+    min_intensity: float (default 5)
+        points with a reflectance below this are not considered stickers,
+        unlike read (default 0) a threshold is required as every point 
+        of every tile is otherwise kept in memory for stage 1. 5 suits 
+        RIEGL reflectance (dB), lower it for other scanners
+    sticker_size: float (default .025)
+        diameter of stickers
+    halo: float (default 2)
+        bright points of neighbouring tiles within halo of a tile are
+        included when searching for targets so targets that straddle
+        tile boundaries are found
+    check_z: boolean (default True)
+        passed to locateTargets
+    expected_codes: list (default [])
+        passed to readCodes
+    codes_dict: str (default 'aruco_mip_16h3')
+        passed to readCodes
+    extract_tiles_w_braces: None or str (default None)
+        path to tiles to extract features from, features are not extracted
+        if None
+    voxel_size: None or float (default None)
+        passed to extractFeatures
+    cache: None or qrdar.io.TileCache (default None)
+        cache used when reading codes and extracting features
+    chunk_size: int (default 1e6)
+        number of points read at a time when streaming tiles
+    n_jobs: int (default 1)
+        number of worker processes, -1 uses all cores
+    resume: boolean (default True)
+        skip work that has a checkpoint in out_dir, if False every
+        stage is rerun. Changing expected_codes, codes_dict, 
+        extract_tiles_w_braces or voxel_size reruns only the stages 
+        that use them
+    verbose: boolean (default False)
+        print something
+
+    Returns
+    -------
+    marker_df: pd.DataFrame
+        output of readCodes for all targets in the plot
+    """
+
+    tiles, tiles_w_braces = tile_list(tiles, tiles_w_braces)
+    for stage in ['bright', 'targets']:
+        if not os.path.isdir(os.path.join(out_dir, stage)): os.makedirs(os.path.join(out_dir, stage))
+    _check_config(out_dir, resume, dict(tiles=[str(t) for t in tiles], tiles_w_braces=tiles_w_braces,
+                                        refl_field=refl_field, min_intensity=min_intensity,
+                                        sticker_size=sticker_size, halo=halo, check_z=check_z),
+                  [('markers.csv', dict(expected_codes=[int(c) for c in expected_codes], codes_dict=str(codes_dict))),
+                   (os.path.join('features', '.done'), dict(extract_tiles_w_braces=extract_tiles_w_braces,
+                                                            voxel_size=voxel_size))])
+    n_jobs = os.cpu_count() if n_jobs < 1 else n_jobs
+
+    # stage 1: stream each tile keeping bright points and the tile extent
+    todo = [t for t in tiles if not (resume and os.path.isfile(_checkpoint(out_dir, 'bright', t)))]
+    if verbose: print('bright: {} of {} tiles to process'.format(len(todo), len(tiles)))
+    scan = functools.partial(_bright_stage, tiles_w_braces=tiles_w_braces, out_dir=out_dir, refl_field=refl_field,
+                             min_intensity=min_intensity, chunk_size=chunk_size)
+    _map(scan, todo, n_jobs)
+    if len(todo) > 0: _invalidate(out_dir)
+
+    extents = np.vstack([_load_extent(_checkpoint(out_dir, 'bright', t)) for t in tiles])
+    tile_index = pd.DataFrame({'tile':tiles, 'xmin':extents[:, 0], 'ymin':extents[:, 1],
+                               'xmax':extents[:, 2], 'ymax':extents[:, 3]})
+    tile_index = tile_index[np.isfinite(extents).all(axis=1)] # empty tiles
+    tile_index.to_csv(os.path.join(out_dir, 'tile_index.csv'), index=False)
+
+    # stage 2: find targets in each tile and its halo, a target is kept by
+    # the tile nearest its centre so targets are found once
+    todo = [t for t in range(len(tiles)) if not (resume and os.path.isfile(_checkpoint(out_dir, 'targets', tiles[t])))]
+    if verbose: print('targets: {} of {} tiles to process'.format(len(todo), len(tiles)))
+    search = functools.partial(_target_stage, tiles=tiles, extents=extents, out_dir=out_dir, halo=halo,
+                               sticker_size=sticker_size, check_z=check_z)
+    _map(search, todo, n_jobs)
+    if len(todo) > 0: _invalidate(out_dir)
+
+    # stage 3: merge targets into a single DataFrame with unique labels
+    merged = os.path.join(out_dir, 'bright.pkl')
+    if resume and os.path.isfile(merged):
+        bright = pd.read_pickle(merged)
+    else:
+        bright = _merge_targets([_checkpoint(out_dir, 'targets', t) for t in tiles])
+        _atomic(merged, bright.to_pickle)
+    if verbose: print('merge: {} targets'.format(bright.target_labels_.nunique() if len(bright) > 0 else 0))
+
+    # stage 4: read codes, tiles are only read around targets
+    markers = os.path.join(out_dir, 'markers.csv')
+    if resume and os.path.isfile(markers):
+        marker_df = pd.read_csv(markers, index_col=0)
+    else:
+        from qrdar.readMarker import readCodes
+        if len(bright) > 0:
+            marker_df = readCodes(bright, tile_index=tile_index, refl_tiles_w_braces=tiles_w_braces,
+                                  reflectance_field=refl_field, expected_codes=expected_codes,
+                                  codes_dict=codes_dict, print_figure=False, cache=cache,
+                                  n_jobs=n_jobs, verbose=verbose)
+        else:
+            marker_df = pd.DataFrame(columns=['x', 'y', 'z', 'rmse', 'code', 'confidence',
+                                              'rotation', 'margin', 'c0', 'c1', 'c2', 'c3'])
+        _atomic(markers, marker_df.to_csv)
+    if verbose: print('codes: {} markers read'.format(marker_df.code.notnull().sum()))
+
+    # stage 5: extract features around each marker
+    features = os.path.join(out_dir, 'features')
+    if extract_tiles_w_braces is not None and not (resume and os.path.isfile(os.path.join(features, '.done'))):
+        from qrdar.extractFeatures import extractFeatures
+        if not os.path.isdir(features): os.makedirs(features)
+        extractFeatures(marker_df[marker_df.code.notnull()], tile_index, extract_tiles_w_braces, features,
+                        cache=cache, voxel_size=voxel_size, verbose=verbose)
+        open(os.path.join(features, '.done'), 'w').close()
+
+    return marker_df
+
+
+def tile_list(tiles, tiles_w_braces=None):
+
+    """
+    returns the tile names and the path to tiles with {} in place of
+    the tile name, tiles is a directory of tiles, a tile index or a
+    path to a .csv tile index
+    """
+
+    if isinstance(tiles, str) and os.path.isdir(tiles):
+        paths = sorted(glob.glob(os.path.join(tiles, '*.ply')) + glob.glob(os.path.join(tiles, '*.pcd')))
+        if len(paths) == 0:
+            raise ValueError('no .ply or .pcd tiles found in {}'.format(tiles))
+        ext = set([os.path.splitext(p)[1] for p in paths])
+        if len(ext) > 1:
+            raise ValueError('tile directory contains both .ply and .pcd files')
+        names = [os.path.splitext(os.path.basename(p))[0] for p in paths]
+        return names, os.path.join(tiles, '{}' + ext.pop())
+
+    if isinstance(tiles, str):
+        tiles = pd.read_csv(tiles)
+    assert tiles_w_braces is not None and '{}' in tiles_w_braces, \
+        'tiles_w_braces needs to be a path with {} when tiles is a tile index'
+    name = 'tile' if 'tile' in tiles.columns else 'tile_number'
+    return list(tiles[name]), tiles_w_braces
+
+
+def scan_tile(fp, refl_field='intensity', min_intensity=5, chunk_size=1000000):
+
+    """
+    streams a tile once returning points with a reflectance of at least
+    min_intensity and the extent of all points [xmin, ymin, xmax, ymax]
+    """
+
+    extent = np.array([np.inf, np.inf, -np.inf, -np.inf])
+
+    def predicate(c):
+        x, y = np.asarray(c['x']), np.asarray(c['y'])
+        if len(x) > 0:
+            extent[:2] = np.minimum(extent[:2], [x.min(), y.min()])
+            extent[2:] = np.maximum(extent[2:], [x.max(), y.max()])
+        return np.asarray(c[refl_field]) >= min_intensity
+
+    reader = read_ply if fp.endswith('.ply') else read_pcd
+    bright = reader(fp, fields=['x', 'y', 'z', refl_field], predicate=predicate, chunk_size=chunk_size)
+
+    return bright, extent
+
+
+def _bright_stage(tile, tiles_w_braces=None, out_dir=None, refl_field='intensity',
+                  min_intensity=5, chunk_size=1000000):
+
+    bright, extent = scan_tile(tiles_w_braces.format(tile), refl_field=refl_field,
+                               min_intensity=min_intensity, chunk_size=chunk_size)
+    points = bright[['x', 'y', 'z', refl_field]].to_numpy(dtype=np.float64)
+    _atomic(_checkpoint(out_dir, 'bright', tile),
+            lambda fp: np.savez(fp, points=points, extent=extent, field=refl_field))
+
+
+def _load_extent(fp):
+
+    with np.load(fp) as npz:
+        return npz['extent']
+
+
+def _target_stage(t, tiles=None, extents=None, out_dir=None, halo=2., sticker_size=.025, check_z=True):
+
+    from qrdar.search4stickers import find, filterBySize
+    from qrdar.locateTargets import locateTargets
+
+    # bright points of this tile and any neighbours within halo
+    lo, hi = extents[t, :2] - halo, extents[t, 2:] + halo
+    neighbours = np.where((extents[:, 0] <= hi[0]) & (extents[:, 2] >= lo[0]) &
+                          (extents[:, 1] <= hi[1]) & (extents[:, 3] >= lo[1]))[0]
+    points, field = [], None
+    for n in neighbours:
+        with np.load(_checkpoint(out_dir, 'bright', tiles[n])) as npz:
+            p, field = npz['points'], str(npz['field'])
+        points.append(p[(p[:, 0] >= lo[0]) & (p[:, 0] <= hi[0]) & (p[:, 1] >= lo[1]) & (p[:, 1] <= hi[1])])
+
+    # a tile with no points has an infinite extent and no neighbours,
+    # an empty checkpoint is written so the tile is not processed again
+    if len(points) == 0:
+        with np.load(_checkpoint(out_dir, 'bright', tiles[t])) as npz:
+            field = str(npz['field'])
+        points = [np.empty((0, 4))]
+    pc = pd.DataFrame(np.vstack(points), columns=['x', 'y', 'z', field])
+
+    targets = pd.DataFrame(columns=['x', 'y', 'z', field, 'sticker_labels_', 'target_labels_'])
+    if len(pc) > 0:
+        pc = filterBySize(find(pc, sticker_size=sticker_size))
+    if len(pc) > 0:
+        pc = locateTargets(pc, check_z=check_z)
+    if len(pc) > 0 and 'target_labels_' in pc.columns:
+        centres = pc.groupby('target_labels_')[['x', 'y']].mean()
+        owner = _owner(centres.values, extents)
+        pc = pc[pc.target_labels_.isin(centres.index[owner == t])]
+        targets = pc[['x', 'y', 'z', field, 'sticker_labels_', 'target_labels_']]
+
+    _atomic(_checkpoint(out_dir, 'targets', tiles[t]), targets.to_pickle)
+
+
+def _owner(xy, extents):
+
+    """
+    index of the tile nearest each point, distance is 0 within a tile,
+    ties go to the first tile
+    """
+
+    dx = np.maximum(np.maximum(extents[:, 0] - xy[:, [0]], xy[:, [0]] - extents[:, 2]), 0)
+    dy = np.maximum(np.maximum(extents[:, 1] - xy[:, [1]], xy[:, [1]] - extents[:, 3]), 0)
+    return np.argmin(dx**2 + dy**2, axis=1)
+
+
+def _merge_targets(checkpoints):
+
+    """
+    concatenates per tile targets, offsetting labels so they are unique
+    """
+
+    merged, n_stickers, n_targets = [], 0, 0
+    for fp in checkpoints:
+        targets = pd.read_pickle(fp)
+        if len(targets) == 0: continue
+        targets = targets.copy()
+        for col, offset in [('sticker_labels_', n_stickers), ('target_labels_', n_targets)]:
+            targets[col] = np.unique(targets[col].values, return_inverse=True)[1] + offset
+        n_stickers, n_targets = targets.sticker_labels_.max() + 1, targets.target_labels_.max() + 1
+        merged.append(targets)
+
+    if len(merged) == 0:
+        return pd.DataFrame(columns=['x', 'y', 'z', 'sticker_labels_', 'target_labels_'])
+    return pd.concat(merged, ignore_index=True)
+
+
+def _check_config(out_dir, resume, config, stages=[]):
+
+    """
+    checkpoints are only reused if they were created with the same
+    parameters. stages is a list of (checkpoint, parameters) for the 
+    stages after targets are merged, if the parameters of one of these
+    change its checkpoint and those of the following stages are 
+    removed rather than raising an error
+    """
+
+    fp = os.path.join(out_dir, 'pipeline.json')
+    stages = json.loads(json.dumps(stages)) # as stored
+    if resume and os.path.isfile(fp):
+        with open(fp) as fh: stored = json.load(fh)
+        if stored.get('config') != config:
+            raise ValueError('checkpoints in {} were created with different parameters, ' \
+                             'use resume=False or a new out_dir'.format(out_dir))
+        stored = dict(stored.get('stages', []))
+        for i, (stage, params) in enumerate(stages):
+            if stored.get(stage) != params:
+                for later, _ in stages[i:]:
+                    if os.path.isfile(os.path.join(out_dir, later)): os.remove(os.path.join(out_dir, later))
+                break
+    elif not resume:
+        _invalidate(out_dir)
+    _atomic(fp, functools.partial(_write_json, dict(config=config, stages=stages)))
+
+
+def _invalidate(out_dir):
+
+    """
+    removes the checkpoints of the merged stages, these are rebuilt 
+    when any tile is (re)processed
+    """
+
+    for stage in ['bright.pkl', 'markers.csv', os.path.join('features', '.done')]:
+        if os.path.isfile(os.path.join(out_dir, stage)): os.remove(os.path.join(out_dir, stage))
+
+
+def _write_json(obj, fp):
+
+    with open(fp, 'w') as fh:
+        json.dump(obj, fh)
+
+
+def _checkpoint(out_dir, stage, tile):
+
+    return os.path.join(out_dir, stage, '{}.{}'.format(tile, 'npz' if stage == 'bright' else 'pkl'))
+
+
+def _atomic(fp, write):
+
+    """
+    writes to a temporary file then renames so a checkpoint is never
+    left half written
+    """
+
+    tmp = os.path.join(os.path.dirname(fp), '.tmp.' + os.path.basename(fp)) # keeps the extension
+    write(tmp)
+    os.replace(tmp, fp)
+
+
+def _map(func, jobs, n_jobs):
+
+    if n_jobs != 1 and len(jobs) > 1:
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            list(pool.map(func, jobs))
+    else:
+        [func(job) for job in jobs]
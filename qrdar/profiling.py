@@ -0,0 +1,205 @@
+import json
+import time
+import tracemalloc
+
+# spans are recorded with a Profiler, functions take profiler=None and
+# fall back to NULL whose spans do nothing so there is no cost when
+# profiling is not required
+
+class Profiler(object):
+
+    """
+    Records nested timing spans with counters and optional peak memory.
+
+    >>> profiler = Profiler()
+    >>> with profiler.span('find', points_in=len(pc)) as s:
+    ...     pc = find(pc)
+    ...     s.count(points_out=len(pc))
+    >>> profiler.summary()
+
+    Parameters
+    ----------
+    memory: boolean (default False)
+        record the peak memory allocated within each span with
+        tracemalloc, this slows down allocation heavy code
+    """
+
+    def __init__(self, memory=False):
+
+        self.memory = memory
+        self.records = []
+        self._stack = []
+        self._t0 = time.perf_counter()
+
+    def __bool__(self):
+
+        return True
+
+    def span(self, name, **counters):
+
+        """
+        context manager that times the enclosed block, counters are
+        passed as keywords or added with span.count
+        """
+
+        return _Span(self, name, counters)
+
+    def path(self):
+
+        """ path of the current span e.g. readCodes/decode """
+
+        return '/'.join(s.name for s in self._stack)
+
+    def merge(self, records):
+
+        """
+        adds records from another Profiler (e.g. one run in a worker
+        process) beneath the current span
+        """
+
+        prefix = self.path()
+        for r in records:
+            r = dict(r)
+            if prefix: r['path'] = prefix + '/' + r['path']
+            self.records.append(r)
+
+    def to_json(self, path=None):
+
+        """
+        returns the records as a JSON string, written to path if given
+        """
+
+        s = json.dumps(self.records, indent=1, default=float)
+        if path is not None:
+            with open(path, 'w') as fh: fh.write(s)
+        return s
+
+    def summary(self):
+
+        """
+        pd.DataFrame with one row per span path of the number of calls,
+        total and mean time, maximum peak memory (MB) and the sum of
+        each counter
+        """
+
+        import pandas as pd
+
+        rows = []
+        for r in self.records:
+            row = {'path':r['path'], 'calls':1, 'time (s)':r['time']}
+            if r.get('peak') is not None: row['peak (MB)'] = r['peak'] / 1e6
+            row.update(r['counters'])
+            rows.append(row)
+        if len(rows) == 0: return pd.DataFrame(columns=['calls', 'time (s)', 'mean (s)'])
+
+        df = pd.DataFrame(rows)
+        agg = {c:'sum' for c in df.columns if c != 'path'}
+        if 'peak (MB)' in agg: agg['peak (MB)'] = 'max'
+        summary = df.groupby('path', sort=False).agg(agg)
+        summary.insert(2, 'mean (s)', summary['time (s)'] / summary['calls'])
+        return summary
+
+
+class _Span(object):
+
+    def __init__(self, profiler, name, counters):
+
+        self.profiler = profiler
+        self.name = name
+        self.counters = dict(counters)
+
+    def count(self, **counters):
+
+        """ sets counters, numbers are added to existing values """
+
+        for k, v in counters.items():
+            self.counters[k] = self.counters.get(k, 0) + v
+
+    def __enter__(self):
+
+        p = self.profiler
+        self.parent = p._stack[-1] if len(p._stack) > 0 else None
+        p._stack.append(self)
+        if p.memory:
+            self._own_trace = not tracemalloc.is_tracing()
+            if self._own_trace: tracemalloc.start()
+            current, peak = tracemalloc.get_traced_memory()
+            # peaks are reset for this span, the outer span is told
+            # about the peak so far so it is not lost
+            if self.parent is not None: self.parent._child_peak = max(self.parent._child_peak, peak)
+            tracemalloc.reset_peak()
+            self._base, self._child_peak = current, 0
+        self._start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+
+        t = time.perf_counter()
+        p = self.profiler
+        peak = None
+        if p.memory:
+            peak = max(tracemalloc.get_traced_memory()[1], self._child_peak)
+            if self.parent is not None: self.parent._child_peak = max(self.parent._child_peak, peak)
+            if self._own_trace: tracemalloc.stop()
+            peak -= self._base
+        p.records.append({'name':self.name, 'path':p.path(), 'start':self._start - p._t0,
+                          'time':t - self._start, 'peak':peak, 'counters':self.counters})
+        p._stack.pop()
+        return False
+
+
+class _NullSpan(object):
+
+    counters = None
+
+    def count(self, **counters):
+        pass
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        return False
+
+
+class _NullProfiler(object):
+
+    """ profiler that records nothing """
+
+    memory = False
+    records = []
+
+    def __bool__(self):
+        return False
+
+    def span(self, name, **counters):
+        return _null_span
+
+    def path(self):
+        return ''
+
+    def merge(self, records):
+        pass
+
+
+_null_span = _NullSpan()
+NULL = _NullProfiler()
+
+def as_profiler(profiler):
+
+    """
+    returns profiler or NULL if profiler is None
+    """
+
+    return NULL if profiler is None else profiler
+
+def run_profiled(func, memory, *args, **kwargs):
+
+    """
+    calls func(*args, profiler=Profiler(memory), **kwargs), used to
+    profile work in other processes. Returns the result and the 
+    records which can be added to a profiler with Profiler.merge
+    """
+
+    profiler = Profiler(memory=memory)
+    return func(*args, profiler=profiler, **kwargs), profiler.records
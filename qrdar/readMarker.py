@@ -1,12 +1,17 @@
 
+import functools
 import pandas as pd
-from sklearn.cluster import DBSCAN
-import matplotlib.pyplot as plt
+from concurrent.futures import ProcessPoolExecutor
 
 import qrdar
 from qrdar.common import *
 from qrdar.io.pcd_io import *
 from qrdar.io.ply_io import *
+from qrdar.io.cache import *
+from qrdar.io.spatial_index import *
+from qrdar.io.batch import *
+from qrdar.diagnostics import *
+from qrdar.profiling import as_profiler, run_profiled
 
 # a bit of hack for Python 2.x
 # __dir__ = os.path.split(os.path.abspath(qrdar.__file__))[0]
@@ -22,12 +27,21 @@ def readCodes(bright,
               expected_codes=[],
               codes_dict='aruco_mip_16h3',
               save_to=False,
-              print_figure=True, 
+              print_figure=True,
               sticker_error =.015,
               code_dims={'edge':.03, 'x':(-.01, .18), 'y':(-.05, .05), 'z':(.06, .25)},
               return_marker_df=True,
               save_pc=False,
-              verbose=True
+              verbose=True,
+              targets=None,
+              pc_index=None,
+              tile_size=None,
+              executor=None,
+              diagnostics=None,
+              return_figures=False,
+              cache=None,
+              n_jobs=1,
+              profiler=None
               ):
 
     """
@@ -42,8 +56,8 @@ def readCodes(bright,
         Dataframe containing output from locateTargets
     pc:
         full point cloud from which to extract targets
-    tile_index: pd.DataFrame [required fields are ['x', 'y', 'tile_number']]
-        tile index as dataframe
+    tile_index: pd.DataFrame [required fields are ['x', 'y', 'tile']] or qrdar.io.TileIndex
+        tile index as dataframe of tile centres or a prebuilt TileIndex
     refl_tiles_w_braces: str with {} (default '')
         path to tiles where tile number is replaced with {} e.g. '../tiles/tile_{}.pcd'. If pc
         is pd.DataFrame this is required.
@@ -55,10 +69,13 @@ def readCodes(bright,
     expected_codes: None or list (default None)
         a list of expected targets, if None all codes in codes_dict expected
     codes_dict: str ('aruco_mip_16h3') or n x n x m array
-        defaults to 'aruco_mip_16h3' but another dictionary can be provided
+        defaults to 'aruco_mip_16h3' but another dictionary can be provided,
+        either as an array or the name of a dictionary added with 
+        qrdar.common.register_codes
     print_figure: boolean (default True)
         creates images of extracted markers, can be useful for identifying codes that were
-        not done so automatically. Saves to file.
+        not done so automatically. Saves to file. Images are rendered in the background 
+        (on executor if given) once all targets are decoded, see return_figures.
     sticker_error: float (default .015)
         accpetable rmse for a target stickers to match the template
     code_dims: dict('edge':.032, 'x':(-.01, .18), 'y':(-.1, .1), 'z':(.06, .25))  
@@ -69,203 +86,336 @@ def readCodes(bright,
         save point clouds of markers
     verbose: boolean (default True)
         print something
+    targets: None or pd.DataFrame (default None)
+        per target records returned by locateTargets(..., return_targets=True),
+        the transforms are reused instead of matching stickers to the 
+        template again so locateTargets should use the same markerTemplate. 
+        Targets without a record (or whose stickers have changed) are 
+        matched as before
+    pc_index: None or qrdar.io.PointIndex (default None)
+        spatial index of pc used to crop targets, built if pc is given
+        and pc_index is None. Pass one to reuse it between calls
+    tile_size: None or float (default None)
+        edge length of tiles when tile_index is tile centres, if None it is
+        the spacing between tile centres
+    executor: None or concurrent.futures.Executor (default None)
+        executor to decode targets with, overrides n_jobs
+    diagnostics: None or str (default None)
+        path of a .npz archive to write per target diagnostics (points, sticker
+        positions and code images) to, these can be rendered later with
+        qrdar.diagnostics.render_diagnostics
+    return_figures: boolean (default False)
+        also return the futures of the images rendered with print_figure, 
+        future.result() waits for an image and raises any render error
+    cache: None or qrdar.io.TileCache (default None)
+        tiles are read from the cache, useful when rerunning with different
+        parameters
+    n_jobs: int (default 1)
+        number of worker processes used to decode targets, -1 uses all cores
+    profiler: None or qrdar.profiling.Profiler (default None)
+        records a 'readCodes' span with 'read tiles' or 'crop' spans and
+        'match', 'rotate', 'rasterise' and 'score' spans per target, 
+        spans in worker processes are merged into the profiler
     
     Returns
     -------
     marker_df: pd.DataFrame
-        Dataframe of marker number and other metadata
+        Dataframe of marker number and other metadata, rotation is the number
+        of quarter turns between the read and dictionary code and margin the 
+        number of cells separating the best and next best code
+    figures: list of concurrent.futures.Future
+        if return_figures, file names of rendered images as futures
     
     """
     
-    assert isinstance(pc, pd.DataFrame) or isinstance(tile_index, pd.DataFrame), \
-        'pc or tile_index needs to be specified'
-    assert not (isinstance(pc, pd.DataFrame) and isinstance(tile_index, pd.DataFrame)), \
-        'a point cloud and tile index have been specified'
+    profiler = as_profiler(profiler)
+    with profiler.span('readCodes', points_in=len(bright)) as span:
+        assert isinstance(pc, pd.DataFrame) or tile_index is not None, \
+            'pc or tile_index needs to be specified'
+        assert not (isinstance(pc, pd.DataFrame) and tile_index is not None), \
+            'a point cloud and tile index have been specified'
+        if tile_index is not None:
+            tile_index = as_tile_index(tile_index, tile_size=tile_size)
 
-    if isinstance(codes_dict, str):
-        codes = load_codes(codes_dict)
-    else:
-        codes = codes_dict
+        # named dictionaries and their index are cached between calls
+        if isinstance(codes_dict, str):
+            codes = load_code_index(codes_dict)
+        else:
+            codes = code_index(codes_dict)
         
-    if len(expected_codes) == 0:
-        expected_codes = np.arange(codes.shape[2])
-    codes = codes[:, :, expected_codes]
+        if len(expected_codes) == 0:
+            expected_codes = np.arange(codes['n_codes'])
+        else:
+            codes = subset_index(codes, expected_codes)
 
-    if markerTemplate is None:
-        markerTemplate = template()
+        if markerTemplate is None:
+            markerTemplate = template()
     
-    # create a database to store output metadata
-    marker_df = pd.DataFrame(index=bright.target_labels_.unique(), 
-                             columns=['x', 'y', 'z', 'rmse', 'code', 'confidence', 'c0', 'c1', 'c2', 'c3'])
+        # create a database to store output metadata
+        marker_df = pd.DataFrame(index=bright.target_labels_.unique(), 
+                                 columns=['x', 'y', 'z', 'rmse', 'code', 'confidence', 'rotation', 'margin',
+                                          'c0', 'c1', 'c2', 'c3'])
     
-    bright.loc[:, 'intensity'] = bright[reflectance_field]
-    if isinstance(pc, pd.DataFrame):
-        pc.loc[:, 'intensity'] = pc[reflectance_field]
-       
+        bright.loc[:, 'intensity'] = bright[reflectance_field]
+        if isinstance(pc, pd.DataFrame):
+            pc.loc[:, 'intensity'] = pc[reflectance_field]
+            if pc_index is None:
+                with profiler.span('index', points_in=len(pc)):
+                    pc_index = PointIndex(pc)
+
+        # locate stickers
+        target_labels = np.sort(bright.target_labels_.unique().astype(int))
+        target_corners = {target: group.groupby('sticker_labels_').mean()
+                          for target, group in bright.groupby('target_labels_')}
+
+        # read each tile once for all the codes it contains
+        if tile_index is not None:
+            assert refl_tiles_w_braces != '' and '{}' in refl_tiles_w_braces, 'refl_tiles_w_braces needs to be a path with {}'
+            with profiler.span('read tiles', targets=len(target_labels)) as read:
+                tile_points = read_bboxes({target: code_bbox(corners) for target, corners in target_corners.items()},
+                                          tile_index, refl_tiles_w_braces, 
+                                          fields=['x', 'y', 'z', reflectance_field], cache=cache)
+                read.count(points_out=sum(len(p) for p in tile_points.values()))
     
-    for i, target in enumerate(np.sort(bright.target_labels_.unique().astype(int))):
-        
-        if verbose: print('processing targets:', target)
+        jobs = []
+        for i, target in enumerate(target_labels):
             
-        # locate stickers
-        corners = bright[bright.target_labels_ == target].groupby('sticker_labels_').mean()
-        marker_df.loc[target, ['x', 'y', 'z']] = corners[['x', 'y', 'z']].mean()
+            corners = target_corners[target]
+            marker_df.loc[target, ['x', 'y', 'z']] = corners[['x', 'y', 'z']].mean()
         
-        # extract portion of tile containing code
-        if isinstance(tile_index, pd.DataFrame):
-            assert refl_tiles_w_braces != '' and '{}' in refl_tiles_w_braces, 'refl_tiles_w_braces needs to be a path with {}'
-            code = extract_tile(corners, tile_index, refl_tiles_w_braces)
+            # extract portion of tile containing code
+            if tile_index is not None:
+                code = tile_points[target]
+                code.loc[:, 'intensity'] = code[reflectance_field]
+            else:
+                with profiler.span('crop', points_in=len(pc)) as crop:
+                    code = pc_index.crop(pc, code_bbox(corners), fields=['x', 'y', 'z', 'intensity'])
+                    crop.count(points_out=len(code))
+
+            # reuse the transform found by locateTargets
+            match = None
+            if targets is not None and target in targets.index:
+                record = targets.loc[target]
+                if set(record.stickers) == set(corners.index):
+                    match = (list(record.idx), np.asarray(record.R), record.rmse)
+
+            jobs.append((i, target, corners, code, match))
+
+        # targets are independent so can be decoded in parallel, only
+        # the cropped points are sent to workers
+        params = dict(codes=codes, expected_codes=expected_codes, markerTemplate=markerTemplate,
+                      sticker_error=sticker_error, code_dims=code_dims, 
+                      print_figure=print_figure or diagnostics is not None,
+                      save_pc=save_pc, verbose=verbose)
+        decode = functools.partial(_decode_target, **params)
+        if executor is None and (n_jobs == 1 or len(jobs) <= 1):
+            results = [decode(*job, profiler=profiler) for job in jobs]
         else:
-            code = pc[(pc.x.between(corners.x.min() - .1, corners.x.max() + .1)) &
-                      (pc.y.between(corners.y.min() - .1, corners.y.max() + .1)) &
-                      (pc.z.between(corners.z.min() - .1, corners.z.max() + .1))][['x', 'y', 'z', 'intensity']]
-        
-        # create axis for plotting
-        if print_figure:
-            f = plt.figure(figsize=(10, 5))
-            f.text(.01, .05, 'cluster: {}'.format(i), ha='left')
-            ax1 = f.add_axes([0, 0, .32, 1])
-            ax2 = f.add_axes([.33, .5, .32, .49])
-            ax3 = f.add_axes([.33, 0, .32, .49])
-            ax4 = f.add_axes([.66, 0, .32, .49])
-            ax5 = f.add_axes([.66, .5, .32, .49])
-            [ax.axis('off') for ax in [ax1, ax2, ax3, ax4, ax5]]
-        
-        # identify stickers
-        if verbose: print('    locating stickers')
-        idx, R, rmse = calculate_R(corners, markerTemplate)
-        if np.isnan(rmse): continue # need to investiage why this is needed - very rarely though!
-        sticker_centres = corners.loc[idx]
-        marker_df.loc[target, 'rmse'] = rmse
-        marker_df.at[target, 'c0'] = tuple(sticker_centres[['x', 'y', 'z']].loc[sticker_centres.index[0]].round(2))  
-        marker_df.at[target, 'c1'] = tuple(sticker_centres[['x', 'y', 'z']].loc[sticker_centres.index[1]].round(2))  
-        marker_df.at[target, 'c2'] = tuple(sticker_centres[['x', 'y', 'z']].loc[sticker_centres.index[2]].round(2))  
-        if len(sticker_centres) == 4:
-            marker_df.at[target, 'c3'] = tuple(sticker_centres[['x', 'y', 'z']].loc[sticker_centres.index[3]].round(2))  
-
-        if verbose: print('    sticker rmse:', rmse)
-
-        # applying rotation matrix
-        if verbose: print('    applying rotation matrix')
-        sticker_centres.loc[:, ['x', 'y', 'z']] = apply_rotation(R, sticker_centres)
-        code.loc[:, ['x', 'y', 'z']] = apply_rotation(R, code)
-        
-        if len(sticker_centres) == 0 or rmse > sticker_error:
-            if verbose: print("    could not find 3 bright targets that match the markerTemplate")
-            if print_figure: 
-                code.sort_values('y', inplace=True)
-                if verbose: print('    saving images:', '{}.png'.format(i))
-                f.savefig('{}.png'.format(i))
-            continue   
-            
-        # set up and plot point cloud
+            # spans recorded in workers are returned with the result
+            if profiler: decode = functools.partial(run_profiled, decode, profiler.memory)
+            if executor is not None:
+                results = executor.map(decode, *zip(*jobs)) if len(jobs) > 0 else []
+            else:
+                n_jobs = os.cpu_count() if n_jobs < 1 else n_jobs
+                with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+                    results = list(pool.map(decode, *zip(*jobs), chunksize=max(1, len(jobs) // (4 * n_jobs))))
+            if profiler:
+                results = list(results)
+                for result, spans in results: profiler.merge(spans)
+                results = [result for result, spans in results]
+
+        records = []
+        for (i, target, corners, code, match), result in zip(jobs, results):
+            if '_diagnostics' in result: records.append(result.pop('_diagnostics'))
+            for k, v in result.items():
+                marker_df.at[target, k] = v
+
+        # figures are rendered in the background after decoding so they 
+        # do not slow it down
+        if diagnostics is not None:
+            if verbose: print('writing diagnostics to:', diagnostics)
+            write_diagnostics(diagnostics, records)
+        figures = []
         if print_figure:
-            code.sort_values('y', inplace=True, ascending=False)
-            ax1.scatter(code.x, code.z, c=code.intensity, edgecolor='none', s=1, cmap=plt.cm.Spectral_r)
-            ax1.scatter(markerTemplate.x, markerTemplate.z, s=30, edgecolor='b', facecolor='none')
-            ax1.scatter(sticker_centres.x, sticker_centres.z, s=30, edgecolor='r', facecolor='none')      
-
-        # extracting fiducial marker
-        # TODO: make this a function
-        if verbose: print('    extracting fiducial marker')
-        code_ = code.copy()
-        code = code.loc[(code.x.between(*code_dims['x'])) & 
-                        (code.y.between(*code_dims['y'])) &
-                        (code.z.between(*code_dims['z']))]
-        xmin, zmin = code.x.min(), code.z.min()
-        # save pc
-        if save_pc:
-            if verbose: print('    saving point cloud to: {}.ply'.format(i))
-            write_ply('{}.ply'.format(i), apply_rotation(np.linalg.inv(R), code.copy())) 
-            np.savetxt('{}.rot.txt'.format(i), R)   
-        code.x = code.x - code.x.min()
-        code.z = code.z - code.z.min()
-        code.loc[:, 'xx'] = code.x // code_dims['edge']
-        code.loc[:, 'zz'] = code.z // code_dims['edge']
+            if verbose: print('rendering {} images to: {}'.format(len(records), os.getcwd()))
+            figures = render_diagnostics(records, out_dir=os.getcwd(), n_jobs=n_jobs, 
+                                         executor=executor, background=True)
+
+        span.count(targets=len(jobs), codes=int(marker_df.code.notnull().sum()))
+
+    if return_marker_df and return_figures:
+        return marker_df, figures
+    elif return_marker_df:
+        return marker_df    
+    elif return_figures:
+        return figures
+
+
+def _decode_target(i, target, corners, code, match=None, codes=None, expected_codes=None, markerTemplate=None,
+                   sticker_error=.015, code_dims=None, print_figure=False, save_pc=False, profiler=None, 
+                   verbose=False):
+
+    """
+    decodes a single target, returns a dict of values for marker_df,
+    match is (idx, R, rmse) from locateTargets or None to calculate it
+    """
+
+    profiler = as_profiler(profiler)
+    result = {}
+    if verbose: print('processing targets:', target)
     
+    # identify stickers
+    if match is not None:
+        idx, R, rmse = match
+    else:
+        if verbose: print('    locating stickers')
+        with profiler.span('match', stickers=len(corners)) as span:
+            idx, R, rmse = calculate_R(corners, markerTemplate, counters=span.counters)
+    if np.isnan(rmse): return result # need to investiage why this is needed - very rarely though!
+
+    # diagnostics are captured as arrays and rendered later
+    if print_figure:
+        diagnostics = {'i':i, 'target':target}
+        result['_diagnostics'] = diagnostics
+
+    sticker_centres = corners.loc[idx]
+    result['rmse'] = rmse
+    result['c0'] = tuple(sticker_centres[['x', 'y', 'z']].loc[sticker_centres.index[0]].round(2))  
+    result['c1'] = tuple(sticker_centres[['x', 'y', 'z']].loc[sticker_centres.index[1]].round(2))  
+    result['c2'] = tuple(sticker_centres[['x', 'y', 'z']].loc[sticker_centres.index[2]].round(2))  
+    if len(sticker_centres) == 4:
+        result['c3'] = tuple(sticker_centres[['x', 'y', 'z']].loc[sticker_centres.index[3]].round(2))  
+
+    if verbose: print('    sticker rmse:', rmse)
 
-        # TODO: correct for non-flat target
-        #code.loc[:, 'yt'] = code.groupby(['xx', 'zz']).y.transform(np.percentile, 75)
-        #code.loc[:, 'yn'] = code.y - code.yt
-        #code = code.loc[code.yn.between(-.01, .01)]
+    # applying rotation matrix
+    if verbose: print('    applying rotation matrix')
+    with profiler.span('rotate', points_in=len(code)):
+        sticker_centres[['x', 'y', 'z']] = transform_points(R, sticker_centres[['x', 'y', 'z']].values, 
+                                                            dtype=np.float64)
+        code[['x', 'y', 'z']] = transform_points(R, code[['x', 'y', 'z']].values, dtype=np.float64)
     
-        code.sort_values('intensity', inplace=True)
-        if print_figure: 
-            cbar = ax2.scatter(code.x, code.z, c=code.intensity, edgecolor='none', 
-                        s=10, cmap=plt.cm.Greys_r, vmin=-10, vmax=0)
-            [ax2.axhline(z, c='r') for z in np.arange(code_dims['z'][0], code_dims['z'][1], code_dims['edge']) - zmin]
-            [ax2.axvline(z, c='r') for z in np.arange(code_dims['x'][0], code_dims['x'][1], code_dims['edge']) - xmin]         
-
-        # matrix for holding estimated codes and confidence 
-        scores = np.zeros((3, 2))
+    if len(sticker_centres) == 0 or rmse > sticker_error:
+        if verbose: print("    could not find 3 bright targets that match the markerTemplate")
+        return result
         
+    # set up and plot point cloud
+    if print_figure:
+        order = np.argsort(-code.y.values, kind='stable')
+        diagnostics['points'] = decimate(code[['x', 'z', 'intensity']].values[order])
+        diagnostics['template'] = markerTemplate[['x', 'z']].values
+        diagnostics['stickers'] = sticker_centres[['x', 'z']].values
+
+    # extracting fiducial marker
+    # TODO: make this a function
+    if verbose: print('    extracting fiducial marker')
+    code_ = code.copy()
+    code = code.loc[(code.x.between(*code_dims['x'])) & 
+                    (code.y.between(*code_dims['y'])) &
+                    (code.z.between(*code_dims['z']))]
+    xmin, zmin = code.x.min(), code.z.min()
+    # save pc
+    if save_pc:
+        if verbose: print('    saving point cloud to: {}.ply'.format(i))
+        write_ply('{}.ply'.format(i), pd.DataFrame(transform_points(invert_transform(R), code[['x', 'y', 'z']].values), 
+                                                   columns=['x', 'y', 'z'])) 
+        np.savetxt('{}.rot.txt'.format(i), R)   
+    code.x = code.x - code.x.min()
+    code.z = code.z - code.z.min()
+    code.loc[:, 'xx'] = code.x // code_dims['edge']
+    code.loc[:, 'zz'] = code.z // code_dims['edge']
+
+
+    # TODO: correct for non-flat target
+    #code.loc[:, 'yt'] = code.groupby(['xx', 'zz']).y.transform(np.percentile, 75)
+    #code.loc[:, 'yn'] = code.y - code.yt
+    #code = code.loc[code.yn.between(-.01, .01)]
+
+    code.sort_values('intensity', inplace=True)
+    if print_figure: 
+        diagnostics['code_points'] = decimate(code[['x', 'z', 'intensity']].values)
+        diagnostics['hlines'] = np.arange(code_dims['z'][0], code_dims['z'][1], code_dims['edge']) - zmin
+        diagnostics['vlines'] = np.arange(code_dims['x'][0], code_dims['x'][1], code_dims['edge']) - xmin
+
+    # matrix for holding estimated code, rotation, confidence and margin
+    scores = np.zeros((3, 4))
+
+    # rasterise once, each method binarises the same grids
+    with profiler.span('rasterise', points_in=len(code_), points_out=len(code)):
+        try:
+            grids = rasterise_code(code)
+        except Exception as err:
+            if verbose: print('\t{}'.format(err))
+            grids = None
+    
+    with profiler.span('score', candidates=codes['n_codes']):
+
         # method 1
         try:
-            img_1 = method_1(code)
-            scores[0, :] = calculate_score(img_1, codes)
-            if print_figure: ax3.imshow(np.rot90(img_1, 1), cmap=plt.cm.Greys_r, interpolation='none')
+            img_1 = method_1(code, grids=grids)
+            scores[0, :] = score_code(img_1, codes)
+            if print_figure: diagnostics['img_1'] = img_1
         except Exception as err:
             if verbose: print(('\t{}'.format(err)))    
-        
+    
         # method 2 .4 threshold
         try:
-            img_2 = method_2(code, .4)
-            scores[1, :] = calculate_score(img_2, codes)
-            if print_figure: ax4.imshow(np.rot90(img_2, 1), cmap=plt.cm.Greys_r, interpolation='none')
+            img_2 = method_2(code, .4, grids=grids)
+            scores[1, :] = score_code(img_2, codes)
+            if print_figure: diagnostics['img_2'] = img_2
         except Exception as err:
             if verbose: print('\t{}'.format(err))
-            
+        
         # method 2 .6 threshold
         try:
-            img_3 = method_2(code, .6)
-            scores[2, :] = calculate_score(img_3, codes)
-            if print_figure: ax5.imshow(np.rot90(img_3, 1), cmap=plt.cm.Greys_r, interpolation='none') 
+            img_3 = method_2(code, .6, grids=grids)
+            scores[2, :] = score_code(img_3, codes)
+            if print_figure: diagnostics['img_3'] = img_3
         except Exception as err:
             if verbose: print('\t{}'.format(err))
 
-        number = np.unique(scores[np.where(scores[:, 1] == scores[:, 1].max())][:, 0])
-        if len(number) > 1:
-            if verbose: print('\tmore than one code identified with same confidence:', number)
-            if verbose: print('\tvalue of -1 set for code in marker_df')
-            if verbose: print('\twriting these to {}'.format(os.path.join(os.getcwd(), str(i) + '.log')))
-            read_code = [int(expected_codes[int(n)]) for n in number]
-            confidence = scores[np.where(scores[:, 1] == scores[:, 1].max())][0, 1]
-            with open(os.path.join(os.getcwd(), str(i) + '.log'), 'w') as fh:
-                fh.write(' '.join([str(n) for n in number]))
-                fh.write(' {}'.format(confidence))
-        else:
-            number, confidence = scores[np.where(scores[:, 1] == scores[:, 1].max())][0, :]
-            read_code = int(expected_codes[int(number)])
-        if verbose: print('    tag identified (ci): {} ({})'.format(read_code, confidence))
+    best = scores[np.where(scores[:, 2] == scores[:, 2].max())]
+    number = np.unique(best[:, 0])
+    if len(number) > 1:
+        if verbose: print('\tmore than one code identified with same confidence:', number)
+        if verbose: print('\tvalue of -1 set for code in marker_df')
+        if verbose: print('\twriting these to {}'.format(os.path.join(os.getcwd(), str(i) + '.log')))
+        read_code = [int(expected_codes[int(n)]) for n in number]
+        confidence = best[0, 2]
+        with open(os.path.join(os.getcwd(), str(i) + '.log'), 'w') as fh:
+            fh.write(' '.join([str(n) for n in number]))
+            fh.write(' {}'.format(confidence))
+    else:
+        number, rotation, confidence, margin = best[0, :]
+        read_code = int(expected_codes[int(number)])
+        result['rotation'] = int(rotation)
+        result['margin'] = int(margin)
+    if verbose: print('    tag identified (ci): {} ({})'.format(read_code, confidence))
 
-        if print_figure:
-            f.text(.01, .01, 'code: {} ({})'.format(read_code, confidence))
-            f.savefig('{}.png'.format(i))
-            if verbose: print('    saved image to:', '{}.png'.format(i))
+    if print_figure:
+        diagnostics['code'] = read_code
+        diagnostics['confidence'] = confidence
 
-        marker_df.loc[target, 'code'] = read_code
-        marker_df.loc[target, 'confidence'] = confidence
+    result['code'] = read_code
+    result['confidence'] = confidence
 
-    
-    if return_marker_df:
-        return marker_df    
+    return result
 
 
-def extract_tile(corners, tile_centres, filepath):
-    
-    tile_names = []
-    code = pd.DataFrame()   
+def code_bbox(corners, buffer=.1):
+
+    """
+    bounding box around the sticker centres of a target
+    """
+
+    return [corners[['x', 'y', 'z']].min().values - buffer, 
+            corners[['x', 'y', 'z']].max().values + buffer]
+
+
+def extract_tile(corners, tile_index, filepath, fields=['x', 'y', 'z', 'intensity'], 
+                 chunk_size=1000000, cache=None):
     
-    # codes may overlap tiles so read in all tiles and append
-    for ix, cnr in corners.iterrows():
-        tile_name = tile_centres.loc[np.where((np.isclose(cnr.y, tile_centres.y, atol=5) & 
-                                               np.isclose(cnr.x, tile_centres.x, atol=5)))].tile.values[0]
-        if tile_name not in tile_names:
-            tile = read_pcd(filepath.format(tile_name))
-            tile = tile.loc[(tile.x.between(corners.x.min() - .1, corners.x.max() + .1)) & 
-                            (tile.y.between(corners.y.min() - .1, corners.y.max() + .1)) &
-                            (tile.z.between(corners.z.min() - .1, corners.z.max() + .1))]
-            code = code.append(tile)
-            tile_names.append(tile_name)
-             
-    return code
+    # codes may overlap tiles so read in all tiles and append, 
+    # only points around the code are held in memory
+    return read_bboxes({0: code_bbox(corners)}, tile_index, filepath, fields=fields, 
+                       cache=cache, chunk_size=chunk_size)[0]
@@ -11,13 +11,16 @@ def identify_codes_in_pc(pc,
 
     bright = qrdar.search4stickers.find(pc)
     bright = qrdar.search4stickers.filterBySize(bright)
-    bright = qrdar.locateTargets(bright, check_z=False, verbose=False)
-    marker_df = qrdar.readMarker.readCodes(bright, pc=pc, 
-                                           expected_codes=expected,
-                                           print_figure=print_figure,
-                                           codes_dict=codes_dict,
-                                           markerTemplate=marker_template,
-                                           verbose=verbose)
+    bright, targets = qrdar.locateTargets(bright, markerTemplate=marker_template, check_z=False, 
+                                          return_targets=True, verbose=False)
+    marker_df, figures = qrdar.readMarker.readCodes(bright, pc=pc, targets=targets,
+                                                    expected_codes=expected,
+                                                    print_figure=print_figure,
+                                                    codes_dict=codes_dict,
+                                                    markerTemplate=marker_template,
+                                                    return_figures=True,
+                                                    verbose=verbose)
+    for f in figures: f.result()
     
     print(marker_df[['code', 'confidence', 'x', 'y', 'z']])
     return marker_df
@@ -34,10 +37,9 @@ if __name__ == '__main__':
     parser.add_argument('--verbose', action='store_true', help='print something')
     args = parser.parse_args()
   
-    pc = qrdar.io.read_ply(args.pc)
+    pc = qrdar.io.read_ply(args.pc, predicate=lambda c: c[args.refl_field] > args.min_reflectance)
     if args.refl_field != 'intensity':
         pc.rename(columns={args.refl_field:'intensity'}, inplace=True)
-    pc = pc[pc.intensity > args.min_reflectance]
     assert len(pc) > 0, 'pc has no points after filtering, try reducing min_reflectance value (defualt -1)'
     
     # run code
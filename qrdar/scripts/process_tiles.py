@@ -0,0 +1,40 @@
+import argparse
+
+from qrdar.pipeline import process_tiles
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='find, read and extract markers from a tiled plot')
+    parser.add_argument('--tiles', '-t', type=str, required=True,
+                        help='directory of .ply or .pcd tiles or a .csv tile index')
+    parser.add_argument('--odir', '-o', type=str, required=True, help='output and checkpoint directory')
+    parser.add_argument('--tiles_w_braces', type=str, default=None,
+                        help='path to tiles with {} in place of the tile name, required with a tile index')
+    parser.add_argument('--extract', type=str, default=None,
+                        help='path to tiles with {} to extract features from, not extracted if not set')
+    parser.add_argument('--voxel_size', type=float, default=None,
+                        help='cluster features on voxels of this size, every point is clustered if not set')
+    parser.add_argument('--min_reflectance', '-m', type=float, default=5, help='minimum reflectance of stickers')
+    parser.add_argument('--refl_field', '-r', default='intensity', help='name of reflectance field in data')
+    parser.add_argument('--expected', '-e', default=[], nargs='+', help='list of expected codes')
+    parser.add_argument('--halo', type=float, default=2., help='overlap between neighbouring tiles')
+    parser.add_argument('--no_check_z', action='store_true', help='do not check the height of targets')
+    parser.add_argument('--n_jobs', '-n', type=int, default=1, help='number of processes, -1 uses all cores')
+    parser.add_argument('--restart', action='store_true', help='ignore existing checkpoints')
+    parser.add_argument('--verbose', action='store_true', help='print something')
+    args = parser.parse_args()
+
+    marker_df = process_tiles(args.tiles, args.odir,
+                              tiles_w_braces=args.tiles_w_braces,
+                              refl_field=args.refl_field,
+                              min_intensity=args.min_reflectance,
+                              halo=args.halo,
+                              check_z=not args.no_check_z,
+                              expected_codes=[int(e) for e in args.expected],
+                              extract_tiles_w_braces=args.extract,
+                              voxel_size=args.voxel_size,
+                              n_jobs=args.n_jobs,
+                              resume=not args.restart,
+                              verbose=args.verbose)
+
+    print(marker_df[['code', 'confidence', 'x', 'y', 'z']])
@@ -1,14 +1,16 @@
+import os
 import numpy as np
 import pandas as pd
 
-from sklearn.cluster import DBSCAN
+from concurrent.futures import ProcessPoolExecutor
 
 from qrdar.io.pcd_io import *
 from qrdar.io.ply_io import *
+from qrdar.profiling import as_profiler
 
 pd.options.mode.chained_assignment = None  # default='warn'
 
-def read(path, refl_field='intensity', refl_filter=0.):
+def read(path, refl_field='intensity', refl_filter=0., fields=None):
 
     """
     Read in .pcd point cloud
@@ -21,6 +23,9 @@ def read(path, refl_field='intensity', refl_filter=0.):
         field containing reflectance / intensity values
     refl_filter: int or float
         value below which points are filtered
+    fields: None or list (default None)
+        fields to read e.g. ['x', 'y', 'z', 'intensity'], None
+        reads all. refl_field is always read.
 
     Returns
     -------
@@ -28,21 +33,28 @@ def read(path, refl_field='intensity', refl_filter=0.):
         input points filtered by reflectance value
     """
 
-    # read in points and filter
-    pc = read_pcd(path)
-    pc = pc[pc[refl_field] >= refl_filter]
+    if fields is not None and refl_field not in fields:
+        fields = list(fields) + [refl_field]
+
+    # read in points and filter, the filter is applied while reading
+    # so only bright points are held in memory
+    pc = read_pcd(path, fields=fields, predicate=lambda c: c[refl_field] >= refl_filter)
     
     return pc
 
 
-def find(pc, sticker_size=.025, W=50, rgb=False, verbose=False):
+def find(pc, sticker_size=.025, W=50, rgb=False, verbose=False, n_jobs=1, method='dbscan', profiler=None):
     
     """
     Searches a point cloud for bright returns and clusters
     them into potential stickers.
 
-    To improve efficiency, the point cloud is subdivided into
-    n x n quadrants.
+    By default (method is 'dbscan') the point cloud is subdivided into 
+    W x W cells which are clustered independently (and in parallel if 
+    n_jobs != 1). Cells overlap by the clustering distance so stickers 
+    that straddle a cell boundary are merged. If method is 'voxel' 
+    points are clustered with voxel_cluster which has no limit on the 
+    number of points.
 
 
     Parameters
@@ -52,9 +64,17 @@ def find(pc, sticker_size=.025, W=50, rgb=False, verbose=False):
     sticker_size: float (default 0.025)
         diameter of stickers
     W: int (default 50)
-        length of quadrant.
+        length of quadrant, only used when method is 'dbscan'
     rgb: boolean (default False)
         colours points according to cluster.
+    n_jobs: int (default 1)
+        number of worker processes, -1 uses all cores. Only used when
+        method is 'dbscan'
+    method: 'dbscan' or 'voxel' (default 'dbscan')
+        clustering backend, both give the same clusters
+    profiler: None or qrdar.profiling.Profiler (default None)
+        records a 'find' span with the number of points in and out
+        and the number of clusters
      
     Returns
     -------
@@ -63,24 +83,19 @@ def find(pc, sticker_size=.025, W=50, rgb=False, verbose=False):
         number
     """
 
-    pc.loc[:, 'xx'] = (pc.x // W) * W
-    pc.loc[:, 'yy'] = (pc.y // W) * W
-    label_max = 0
-    pc.loc[:, 'sticker_labels_'] = -1
+    eps = sticker_size * 1.1
+    with as_profiler(profiler).span('find', points_in=len(pc)) as span:
+        pc.loc[:, 'xx'] = (pc.x // W) * W
+        pc.loc[:, 'yy'] = (pc.y // W) * W
+
+        if method == 'voxel':
+            if verbose: print('clustering {} points'.format(len(pc)))
+            pc.loc[:, 'sticker_labels_'] = voxel_cluster(pc[['x', 'y', 'z']].values, eps)
+        else:
+            pc.loc[:, 'sticker_labels_'] = _find_dbscan(pc, eps, W, n_jobs, verbose)
     
-    for tx, ty in pc.groupby(['xx', 'yy']).size().index:
-       
-        sq = pc[(pc.xx == tx) & (pc.yy == ty)]
-        if len(sq) > 1e5: 
-            raise Exception('more than 1 million points in a tile, reduce W'))
-        if verbose: print('processing grid {} {} with length {}'.format(tx, ty, len(sq)))
-              
-        dbscan = DBSCAN(eps=sticker_size * 1.1, min_samples=2).fit(sq[['x', 'y', 'z']])
-        idx = np.where(dbscan.labels_ > -1)[0]
-        pc.loc[sq.loc[sq.index[idx]].index, 'sticker_labels_'] = dbscan.labels_[idx] + label_max
-        label_max = pc.sticker_labels_.max() + 1 # iterative labelling hence 
-
-    pc = pc[pc.sticker_labels_ != -1] # remove outlier points
+        pc = pc[pc.sticker_labels_ != -1] # remove outlier points
+        span.count(points_out=len(pc), candidates=pc.sticker_labels_.nunique())
            
     # points can be coloured by cluster for visualisation
     if rgb:
@@ -90,7 +105,237 @@ def find(pc, sticker_size=.025, W=50, rgb=False, verbose=False):
    
     return pc 
 
-def filterBySize(pc, max_size=.05, min_size=0, verbose=False):
+def voxel_cluster(xyz, eps, max_pairs=5000000, max_block=4096):
+
+    """
+    Clusters points into connected components where points closer than
+    eps are connected, labels are the same as 
+    DBSCAN(eps=eps, min_samples=2).fit(xyz).labels_
+
+    Points are hashed into cells with edge length eps / sqrt(3) so all
+    points in a cell are connected without comparing them. Components 
+    are found between cells, a pair of neighbouring cells is linked by 
+    the first pair of points closer than eps and is not tested if the 
+    cells are already connected.
+
+    Parameters
+    ----------
+    xyz: np.array (N x 3)
+        point coordinates
+    eps: float
+        maximum distance between connected points
+    max_pairs: int (default 5e6)
+        number of point pairs compared at a time
+    max_block: int (default 4096)
+        cell pairs with more point pairs than this are tested with a 
+        KD-tree one at a time, skipping those already connected
+
+    Returns
+    -------
+    labels: np.array
+        cluster label of each point, -1 for points with no neighbours
+    """
+
+    from scipy.spatial import cKDTree
+
+    N = len(xyz)
+    if N == 0: return np.array([], dtype=np.int64)
+
+    # cells with a two cell margin so neighbours are valid keys, the
+    # diagonal of a cell is (just) shorter than eps
+    cell = eps / np.sqrt(3) * (1 - 1e-9)
+    ijk = np.floor((xyz - xyz.min(axis=0)) / cell).astype(np.int64) + 2
+    dims = ijk.max(axis=0) + 3
+    keys = np.ravel_multi_index(ijk.T, dims)
+    del ijk
+    order = np.argsort(keys, kind='stable')
+    xyz_s = xyz[order]
+    cells, start, count = np.unique(keys[order], return_index=True, return_counts=True)
+    del keys
+
+    # forward neighbours that can hold a point within eps
+    offsets = [(i, j, k) for i in range(-2, 3) for j in range(-2, 3) for k in range(-2, 3)]
+    offsets = [o for o in offsets if o > (0, 0, 0) and 
+               sum(max(abs(d) - 1, 0)**2 for d in o) * cell**2 <= eps**2]
+    strides = np.array([dims[1] * dims[2], dims[2], 1])
+    va, vb = [], []
+    for o in offsets:
+        target = cells + np.dot(o, strides)
+        pos = np.minimum(np.searchsorted(cells, target), len(cells) - 1)
+        hit = cells[pos] == target
+        va.append(np.where(hit)[0])
+        vb.append(pos[hit])
+    va, vb = np.hstack(va + [[]]).astype(np.int64), np.hstack(vb + [[]]).astype(np.int64)
+
+    # small cell pairs are compared in vectorised batches, pairs whose 
+    # cells are already connected are dropped before each batch
+    parent = np.arange(len(cells))
+    n_pairs = count[va] * count[vb]
+    small = np.where(n_pairs <= max_block)[0]
+    batch = np.cumsum(n_pairs[small]) // max_pairs
+    for b in np.unique(batch):
+        p = small[batch == b]
+        p = p[_find_roots(parent, va[p]) != _find_roots(parent, vb[p])]
+        if len(p) == 0: continue
+        a, v, n = va[p], vb[p], n_pairs[p]
+        pair = np.repeat(np.arange(len(p)), n)
+        local = np.arange(n.sum()) - np.repeat(np.cumsum(n) - n, n)
+        ia = start[a][pair] + local // count[v][pair]
+        ib = start[v][pair] + local % count[v][pair]
+        near = ((xyz_s[ia] - xyz_s[ib])**2).sum(axis=1) <= eps**2
+        linked = np.bincount(pair[near], minlength=len(p)) > 0
+        _union(parent, a[linked], v[linked])
+
+    # large cell pairs (dense patches) one at a time with a KD-tree
+    def root(c):
+        while parent[c] != c:
+            parent[c] = parent[parent[c]]
+            c = parent[c]
+        return c
+
+    trees = {}
+    for p in np.where(n_pairs > max_block)[0]:
+        ra, rb = root(va[p]), root(vb[p])
+        if ra == rb: continue
+        a, v = (va[p], vb[p]) if count[va[p]] <= count[vb[p]] else (vb[p], va[p])
+        if v not in trees: trees[v] = cKDTree(xyz_s[start[v]:start[v] + count[v]])
+        dist = trees[v].query(xyz_s[start[a]:start[a] + count[a]], k=1, 
+                              distance_upper_bound=np.nextafter(eps, np.inf))[0]
+        if np.any(dist <= eps): parent[max(ra, rb)] = min(ra, rb)
+
+    labels = np.repeat(_find_roots(parent, np.arange(len(cells))), count)
+
+    # back to input order, drop singletons and number clusters 
+    # by their first point as DBSCAN does
+    out = np.empty(N, dtype=np.int64)
+    out[order] = labels
+    size = np.bincount(out, minlength=N)
+    first = np.full(N, N)
+    np.minimum.at(first, out, np.arange(N))
+    clusters = np.where(size > 1)[0]
+    rank = np.full(N, -1, dtype=np.int64)
+    rank[clusters[np.argsort(first[clusters])]] = np.arange(len(clusters))
+
+    return rank[out]
+
+def _union(parent, a, b):
+
+    """
+    merges the components of a and b (arrays of nodes) in a union-find
+    forest, only the roots that are touched are updated
+    """
+
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    ra, rb = _find_roots(parent, a), _find_roots(parent, b)
+    linked = ra != rb
+    if not np.any(linked): return
+    edges = np.unique(np.vstack([ra[linked], rb[linked]]), axis=1)
+    nodes, edges = np.unique(edges, return_inverse=True)
+    edges = edges.reshape(2, -1)
+    graph = coo_matrix((np.ones(edges.shape[1]), (edges[0], edges[1])), shape=(len(nodes), len(nodes)))
+    n_comp, comp = connected_components(graph, directed=False)
+    root = np.full(n_comp, len(parent))
+    np.minimum.at(root, comp, nodes)
+    parent[nodes] = root[comp]
+
+def _find_roots(parent, idx):
+
+    """
+    roots of idx in a union-find forest, paths of idx are compressed
+    """
+
+    root = parent[idx]
+    while True:
+        up = parent[root]
+        if np.array_equal(up, root): break
+        root = up
+    parent[idx] = root
+    return root
+
+def _find_dbscan(pc, eps, W, n_jobs, verbose):
+
+    """
+    DBSCAN over W x W cells with halo overlap
+    """
+    
+    # assign points to their cell and to neighbouring cells
+    # they are within eps of, then group with a single sort
+    xy = pc[['x', 'y']].values
+    ij = np.floor(xy / W).astype(np.int64)
+    lo, hi = xy - ij * W < eps, (ij + 1) * W - xy <= eps
+    point_idx, cell_ij = [], []
+    for di in [-1, 0, 1]:
+        for dj in [-1, 0, 1]:
+            m = np.ones(len(pc), dtype=bool)
+            for ax, d in enumerate([di, dj]):
+                if d == -1: m &= lo[:, ax]
+                if d == 1: m &= hi[:, ax]
+            point_idx.append(np.where(m)[0])
+            cell_ij.append(ij[m] + [di, dj])
+    point_idx, cell_ij = np.hstack(point_idx), np.vstack(cell_ij)
+    cells, cell_idx = np.unique(cell_ij, axis=0, return_inverse=True)
+    order = np.argsort(cell_idx.ravel(), kind='stable')
+    point_idx = point_idx[order]
+    splits = np.cumsum(np.bincount(cell_idx.ravel(), minlength=len(cells)))[:-1]
+    groups = np.split(point_idx, splits) if len(cells) > 0 else []
+
+    for (tx, ty), g in zip(cells, groups):
+        if len(g) > 1e5: 
+            raise Exception('more than 100,000 points in a cell, reduce W')
+        if verbose: print('processing grid {} {} with length {}'.format(tx * W, ty * W, len(g)))
+
+    xyz = pc[['x', 'y', 'z']].values
+    jobs = [xyz[g] for g in groups]
+    if n_jobs != 1 and len(jobs) > 1:
+        n_jobs = os.cpu_count() if n_jobs < 1 else n_jobs
+        with ProcessPoolExecutor(max_workers=n_jobs) as pool:
+            labels = list(pool.map(_dbscan, jobs, [eps] * len(jobs)))
+    else:
+        labels = [_dbscan(j, eps) for j in jobs]
+
+    # offset labels and merge clusters that share halo points
+    offsets = np.cumsum([0] + [l.max() + 1 for l in labels])
+    labels = np.hstack([np.where(l > -1, l + o, -1) for l, o in zip(labels, offsets)] + [[]]).astype(np.int64)
+    
+    return _merge_labels(point_idx, labels, len(pc), offsets[-1])
+
+def _dbscan(xyz, eps):
+
+    from sklearn.cluster import DBSCAN
+
+    return DBSCAN(eps=eps, min_samples=2).fit(xyz).labels_
+
+def _merge_labels(point_idx, labels, N, n_labels):
+
+    """
+    points that appear in more than one cell link the labels they
+    were given, linked labels are merged and relabelled 0..n
+    """
+
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+
+    m = labels > -1
+    point_idx, labels = point_idx[m], labels[m]
+    order = np.argsort(point_idx, kind='stable')
+    point_idx, labels = point_idx[order], labels[order]
+    same = point_idx[1:] == point_idx[:-1]
+    graph = coo_matrix((np.ones(same.sum()), (labels[:-1][same], labels[1:][same])), 
+                       shape=(n_labels, n_labels))
+    n, component = connected_components(graph, directed=False)
+
+    # number merged clusters in order of first appearance
+    first = np.full(n, len(component))
+    np.minimum.at(first, component, np.arange(len(component)))
+    rank = np.argsort(np.argsort(first))
+
+    out = np.full(N, -1, dtype=np.int64)
+    out[point_idx] = rank[component[labels]]
+    return out
+
+def filterBySize(pc, max_size=.05, min_size=0, verbose=False, profiler=None):
 
     """
     removes potential stickers that are too big e.g. reflective targets
@@ -104,6 +349,9 @@ def filterBySize(pc, max_size=.05, min_size=0, verbose=False):
         size above which potential stickers are filtered
     verbose:
         print something
+    profiler: None or qrdar.profiling.Profiler (default None)
+        records a 'filterBySize' span with the number of points and
+        stickers in and out
     
     
     Returns
@@ -112,18 +360,23 @@ def filterBySize(pc, max_size=.05, min_size=0, verbose=False):
 
     """
 
-    # group points in to potential stickets and estimate size and locations
-    potential_dots = pc.groupby('sticker_labels_').agg({'x':(np.ptp, np.mean), 'y':(np.ptp, np.mean), 'z':(np.ptp, np.mean)})
-    potential_dots.columns = ['y_ptp', 'y', 'x_ptp', 'x', 'z_ptp', 'z']
-    N = len(potential_dots)
-    if verbose: print("potential stickers found:", N) 
+    with as_profiler(profiler).span('filterBySize', points_in=len(pc)) as span:
+
+        # group points in to potential stickets and estimate size and locations
+        potential_dots = pc.groupby('sticker_labels_').agg({'x':(np.ptp, np.mean), 'y':(np.ptp, np.mean), 'z':(np.ptp, np.mean)})
+        potential_dots.columns = ['y_ptp', 'y', 'x_ptp', 'x', 'z_ptp', 'z']
+        N = len(potential_dots)
+        if verbose: print("potential stickers found:", N) 
     
-    # filter by size
-    func = lambda row: np.max([row['x_ptp'], row['y_ptp'], row['z_ptp']])
-    potential_dots.loc[:, 'max_ptp'] = potential_dots.apply(func, axis=1)
-    potential_dots = potential_dots[potential_dots.max_ptp.between(min_size, max_size)]
-    if verbose: print('stickers removed for being too large', N - len(potential_dots)) 
-    if verbose: print('number of potential stickers:', len(potential_dots))
-
-    return pc[pc.sticker_labels_.isin(potential_dots.index)] 
+        # filter by size
+        func = lambda row: np.max([row['x_ptp'], row['y_ptp'], row['z_ptp']])
+        potential_dots.loc[:, 'max_ptp'] = potential_dots.apply(func, axis=1)
+        potential_dots = potential_dots[potential_dots.max_ptp.between(min_size, max_size)]
+        if verbose: print('stickers removed for being too large', N - len(potential_dots)) 
+        if verbose: print('number of potential stickers:', len(potential_dots))
+
+        pc = pc[pc.sticker_labels_.isin(potential_dots.index)]
+        span.count(points_out=len(pc), candidates=N, stickers=len(potential_dots))
+
+    return pc
 
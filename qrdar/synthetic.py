@@ -0,0 +1,166 @@
+import os
+import numpy as np
+import pandas as pd
+
+from qrdar.common import template, load_codes
+from qrdar.io.pcd_io import *
+from qrdar.io.ply_io import *
+
+def synthetic_marker(code, rng=None, edge=.03, spacing=.004, noise=.001,
+                     white=-2., black=-12., sticker=10., sticker_size=.025):
+
+    """
+    point cloud of a single marker in the template frame, the code is
+    in the x-z plane with the stickers at the template locations
+
+    Parameters
+    ----------
+    code: np.array
+        N x N binary code e.g. load_codes('aruco_mip_16h3')[:, :, i]
+    rng: None or np.random.Generator (default None)
+        random number generator
+    edge: float (default .03)
+        edge length of code squares
+    spacing: float (default .004)
+        distance between points
+    noise: float (default .001)
+        standard deviation of noise added to point positions
+    white, black, sticker: float (default -2, -12, 10)
+        intensity of white and black squares and stickers
+    sticker_size: float (default .025)
+        diameter of stickers
+
+    Returns
+    -------
+    points: np.array
+        M x 4 array of x, y, z, intensity
+    """
+
+    rng = np.random.default_rng() if rng is None else rng
+    N = code.shape[0]
+
+    # the code is read as np.rot90(img) where img[xx, zz] is the cell
+    # at column xx and row zz, see readMarker
+    img = np.rot90(code, -1)
+    T = template()
+    xs = np.arange(-.04, T.x.max() + .05, spacing)
+    zs = np.arange(-.02, max(T.z.max(), .06 + N * edge) + .03, spacing)
+    X, Z = [a.ravel() for a in np.meshgrid(xs, zs)]
+
+    ix = np.floor((X + .01) / edge).astype(int)
+    iz = np.floor((Z - .06) / edge).astype(int)
+    inside = (ix >= 0) & (ix < N) & (iz >= 0) & (iz < N)
+    I = np.full(X.shape, white)
+    I[inside] = np.where(img[ix[inside], iz[inside]] == 1, white, black)
+    points = [np.c_[X, np.zeros_like(X), Z, I + rng.normal(0, .5, X.shape)]]
+
+    # stickers sit slightly in front of the marker
+    n = int(np.pi * (sticker_size / 2)**2 / spacing**2 * 4)
+    for s in T[['x', 'z']].values:
+        a = rng.uniform(0, 2 * np.pi, n)
+        r = np.sqrt(rng.uniform(0, 1, n)) * sticker_size / 2
+        points.append(np.c_[s[0] + r * np.cos(a), np.full(n, -.001), s[1] + r * np.sin(a), np.full(n, sticker)])
+
+    points = np.vstack(points)
+    points[:, :3] += rng.normal(0, noise, (len(points), 3))
+
+    return points
+
+
+def synthetic_stem(rng, radius=.15, height=4., spacing=.02, intensity=-8.):
+
+    """
+    points on the surface of a vertical cylinder centred on the origin
+    """
+
+    n = int(2 * np.pi * radius * height / spacing**2)
+    a = rng.uniform(0, 2 * np.pi, n)
+    return np.c_[radius * np.cos(a), radius * np.sin(a), rng.uniform(0, height, n),
+                 rng.normal(intensity, 2, n)]
+
+
+def synthetic_plot(n_markers=10, size=40., bg_density=100., codes_dict='aruco_mip_16h3',
+                   stems=True, max_tilt=5., min_separation=1., seed=0, **kwargs):
+
+    """
+    synthetic plot of markers in random poses within a noisy
+    background, useful for testing and benchmarking
+
+    Parameters
+    ----------
+    n_markers: int (default 10)
+        number of markers, codes are drawn without replacement
+    size: float (default 40)
+        edge length of the square plot
+    bg_density: float (default 100)
+        number of background points per m2 of plot (between 0 and 5 m)
+    codes_dict: str (default 'aruco_mip_16h3')
+        dictionary to draw codes from
+    stems: boolean (default True)
+        add a stem behind each marker for extractFeatures
+    max_tilt: float (default 5)
+        maximum tilt of markers from vertical in degrees
+    min_separation: float (default 1)
+        minimum horizontal distance between markers, markers are
+        placed closer if there is no room after 100 attempts
+    seed: int (default 0)
+        random seed
+    kwargs:
+        passed to synthetic_marker
+
+    Returns
+    -------
+    pc: pd.DataFrame
+        points with fields ['x', 'y', 'z', 'intensity']
+    truth: pd.DataFrame
+        code and location of each marker
+    """
+
+    rng = np.random.default_rng(seed)
+    codes = load_codes(codes_dict)
+    ids = rng.choice(codes.shape[2], size=n_markers, replace=False)
+
+    points, truth = [], []
+    for code in ids:
+        P = synthetic_marker(codes[:, :, code], rng=rng, **kwargs)
+        if stems: P = np.vstack([P, synthetic_stem(rng) + [.09, .3, -1, 0]])
+
+        # random pose, yaw about z and a small tilt about x
+        yaw = rng.uniform(0, 2 * np.pi)
+        tilt = np.radians(rng.uniform(-max_tilt, max_tilt))
+        Rz = np.array([[np.cos(yaw), -np.sin(yaw), 0], [np.sin(yaw), np.cos(yaw), 0], [0, 0, 1]])
+        Rx = np.array([[1, 0, 0], [0, np.cos(tilt), -np.sin(tilt)], [0, np.sin(tilt), np.cos(tilt)]])
+        for attempt in range(100):
+            position = np.r_[rng.uniform(2, size - 2, 2), rng.uniform(.5, 1.5)]
+            if all(np.hypot(*(position[:2] - t[1:3])) >= min_separation for t in truth): break
+        P[:, :3] = P[:, :3].dot((Rz.dot(Rx)).T) + position
+        points.append(P)
+        truth.append((int(code), position[0], position[1], position[2]))
+
+    n_bg = int(bg_density * size**2)
+    points.append(np.c_[rng.uniform(0, size, (n_bg, 2)), rng.uniform(0, 5, n_bg), rng.uniform(-20, -3, n_bg)])
+
+    pc = pd.DataFrame(np.vstack(points), columns=['x', 'y', 'z', 'intensity'])
+    return pc, pd.DataFrame(truth, columns=['code', 'x', 'y', 'z'])
+
+
+def write_tiles(pc, out_dir, tile_size=10., fmt='pcd'):
+
+    """
+    splits pc into square tiles written to out_dir/tile_<n>.<fmt>,
+    returns a tile index of tile centres
+    """
+
+    if not os.path.isdir(out_dir): os.makedirs(out_dir)
+    tx, ty = (pc.x // tile_size).astype(int), (pc.y // tile_size).astype(int)
+
+    rows = []
+    for n, ((i, j), tile) in enumerate(pc.groupby([tx, ty])):
+        fp = os.path.join(out_dir, 'tile_{}.{}'.format(n, fmt))
+        if fmt == 'ply':
+            write_ply(fp, tile.reset_index(drop=True))
+        else:
+            write_pcd(tile.reset_index(drop=True), fp)
+        rows.append((n, (i + .5) * tile_size, (j + .5) * tile_size))
+
+    return pd.DataFrame(rows, columns=['tile', 'x', 'y'])